@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+"""
+Module Docstring
+Runs 'cleanLast.prepare_last', 'cleanLast.filter_overlap' and 'findSplits.locate_splits'
+for every sample of a manifest, one sample per worker process.
+The manifest has one sample per line, with the target, the query and optionally the
+gap part of the file names (default 'gap'), e.g.
+    orsadb  7002
+    orsadb  9023R   gap
+which runs the steps on 'lastgap_Torsadb_Q7002.txt' and so on. Empty lines and lines
+starting with '#' are ignored.
+A step is skipped when its output is newer than its input, so a rerun only repeats the
+work that is missing or out of date. The status and run time of every step is written
+to a tab-separated report.
+"""
+
+__author__ = "Harald Grove"
+__version__ = "0.1.0"
+__license__ = "MIT"
+
+import argparse
+import multiprocessing
+import os
+import time
+import sys
+import lastio
+import cleanLast
+import findSplits
+
+# Default gap part of the file names
+GAP = "gap"
+# Input and output of each step, formatted with the target, query and gap
+# ('locate_splits' uses the first three letters of the gap)
+STEPS = [
+    (
+        "prepare_last",
+        "last{gap}_T{target}_Q{query}.txt",
+        "last{gap}_T{target}_Q{query}.E0.txt",
+    ),
+    (
+        "filter_overlap",
+        "last{gap}_T{target}_Q{query}.E0.txt",
+        "last{gap}_T{target}_Q{query}.E0.QC.txt",
+    ),
+    (
+        "locate_splits",
+        "last{gap:.3}_T{target}_Q{query}.E0.QC.txt",
+        "last{gap:.3}_T{target}_Q{query}_splits.E0.QC.txt",
+    ),
+]
+REPORT = ["target", "query", "gap", "step", "status", "seconds", "message"]
+
+
+def read_manifest(filename):
+    """
+    Reads the samples of a manifest.
+    :return: List of (target, query, gap)
+    """
+    samples = []
+    with open(filename, "r") as fin:
+        for lineno, line in enumerate(fin, 1):
+            if line.startswith("#") or len(line.strip()) == 0:
+                continue
+            l = line.strip().split()
+            if len(l) not in (2, 3):
+                raise ValueError(
+                    "Expected target, query and gap on line {} of {}".format(
+                        lineno, filename
+                    )
+                )
+            samples.append((l[0], l[1], l[2] if len(l) == 3 else GAP))
+    return samples
+
+
+def is_current(infile, outfile):
+    """ Tells if 'outfile' exists and is newer than 'infile' """
+    try:
+        return os.path.getmtime(outfile) >= os.path.getmtime(infile)
+    except OSError:
+        return False
+
+
+def _run_step(step, target, query, gap, cache=False):
+    if step == "prepare_last":
+        cleanLast.prepare_last(target, query, gap, cache)
+    elif step == "filter_overlap":
+        cleanLast.filter_overlap(target, query, gap)
+    elif step == "locate_splits":
+        findSplits.locate_splits(target, query, gap, cache)
+
+
+def run_sample(sample, force=False, cache=False):
+    """
+    Runs the steps of one sample, stopping at the first that fails.
+    :param cache: Keep the parsed inputs in sidecar caches, see 'parseLast.read_typed'
+    :return: List of report rows, one per step
+    """
+    target, query, gap = sample
+    rows = []
+    for step, infile, outfile in STEPS:
+        infile = infile.format(target=target, query=query, gap=gap)
+        outfile = outfile.format(target=target, query=query, gap=gap)
+        if step == "prepare_last":
+            infile = lastio.find_file(infile)
+        if not force and is_current(infile, outfile):
+            rows.append([target, query, gap, step, "skipped", "0.00", ""])
+            continue
+        start = time.time()
+        try:
+            _run_step(step, target, query, gap, cache)
+        except Exception as err:
+            seconds = "{:.2f}".format(time.time() - start)
+            message = "{}: {}".format(type(err).__name__, err).replace("\t", " ")
+            rows.append([target, query, gap, step, "failed", seconds, message])
+            break
+        seconds = "{:.2f}".format(time.time() - start)
+        rows.append([target, query, gap, step, "done", seconds, ""])
+    return rows
+
+
+def _run_sample(task):
+    return run_sample(*task)
+
+
+def run_batch(samples, fout, jobs=1, force=False, cache=False):
+    """
+    Runs the samples on 'jobs' worker processes, writing the report rows of each
+    sample to 'fout' as it finishes.
+    :return: Number of samples with a failed step
+    """
+    failed = 0
+    fout.write("\t".join(REPORT) + "\n")
+    tasks = [(sample, force, cache) for sample in samples]
+    with multiprocessing.Pool(max(jobs, 1)) as pool:
+        for rows in pool.imap_unordered(_run_sample, tasks):
+            fout.writelines("\t".join(row) + "\n" for row in rows)
+            fout.flush()
+            if rows[-1][4] == "failed":
+                failed += 1
+                sys.stderr.write(
+                    "Sample [{}] [{}] failed in {}: {}\n".format(
+                        rows[-1][0], rows[-1][1], rows[-1][3], rows[-1][6]
+                    )
+                )
+    return failed
+
+
+def main(args):
+    """ Main entry point of the app """
+    samples = read_manifest(args.manifest)
+    if args.outfile is None:
+        failed = run_batch(samples, sys.stdout, args.jobs, args.force, args.cache)
+    else:
+        with open(args.outfile, "w") as fout:
+            failed = run_batch(samples, fout, args.jobs, args.force, args.cache)
+    sys.stderr.write("{} of {} samples failed\n".format(failed, len(samples)))
+    if args.log:
+        with open("README.txt", "a") as fout:
+            fout.write("[{}]\t[{}]\n".format(time.asctime(), " ".join(sys.argv)))
+    return 1 if failed > 0 else 0
+
+
+if __name__ == "__main__":
+    """ This is executed when run from the command line """
+    parser = argparse.ArgumentParser()
+
+    # Required positional argument
+    parser.add_argument("manifest", help="Samples to run, one per line")
+
+    # Optional argument flag which defaults to False
+    parser.add_argument(
+        "-l",
+        "--log",
+        action="store_true",
+        default=False,
+        help="Save command to 'README.txt'",
+    )
+    parser.add_argument(
+        "-f",
+        "--force",
+        action="store_true",
+        default=False,
+        help="Run every step, also when its output is up to date",
+    )
+    parser.add_argument(
+        "-C",
+        "--cache",
+        action="store_true",
+        default=False,
+        help="Keep the parsed inputs in '<infile>.cache' directories and reuse them",
+    )
+
+    # Optional argument which requires a parameter (eg. -d test)
+    parser.add_argument("-o", "--outfile", help="Report file [stdout]")
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=1,
+        help="Number of samples run at the same time",
+    )
+
+    # Optional verbosity counter (eg. -v, -vv, -vvv, etc.)
+    parser.add_argument(
+        "-v", "--verbose", action="count", default=0, help="Verbosity (-v, -vv, etc)"
+    )
+
+    # Specify output of '--version'
+    parser.add_argument(
+        "--version",
+        action="version",
+        version="%(prog)s (version {version})".format(version=__version__),
+    )
+
+    args = parser.parse_args()
+    sys.exit(main(args))
@@ -1,5 +1,6 @@
 #! /usr/bin/env python
 
+import argparse
 import sys
 import pandas as pd
 import matplotlib.pyplot as plt
@@ -7,129 +8,133 @@ import numpy as np
 import matplotlib.colors as colors
 import matplotlib.cm as cm
 import matplotlib.patches as patches
+import lastio
+import parseLast
 
+# Queries run when none is given
+QUERIES = [
+    "7002",
+    "7003",
+    "7010",
+    "7011",
+    "7012",
+    "7016",
+    "8001",
+    "8002",
+    "8003",
+    "8005R",
+    "8006",
+    "9006R",
+    "9007R",
+    "9011R",
+    "9012",
+    "9018R",
+    "9016R",
+    "9023R",
+]
 
-def prepare_last(target, query, gap):
+
+def prepare_last(target, query, gap, cache=False):
     """
     Filter out hits with E-value above 0
+    The file is read in chunks with the types of 'parseLast.SCHEMA', keeping only the
+    hits that pass, and the result is kept in a sidecar cache when 'cache' is set.
+    A gzip or zstd compressed last-file is used if the plain one is missing.
     """
-    header_l = [
-        "score",
-        "name1",
-        "start1",
-        "alnSize1",
-        "strand1",
-        "seqSize1",
-        "name2",
-        "start2",
-        "alnSize2",
-        "strand2",
-        "seqSize2",
-        "blocks",
-        "EG",
-        "E",
-    ]
     filename = "last{}_T{}_Q{}.txt".format(gap, target, query)
-    df = pd.read_csv(
-        filename, comment="#", header=None, names=header_l, delim_whitespace=True
+    df = parseLast.read_typed(
+        lastio.find_file(filename), header=False, max_evalue=0, cache=cache
     )
-    # Remove hits with E-value different from 0 and write new file
-    df1 = df[df["E"] == "E=0"]
-    df1.to_csv(filename.rsplit(".", 1)[0] + ".E0.txt", sep="\t", index=None)
+    # Write the hits with E-value 0 to a new file
+    parseLast.write_typed(df, filename.rsplit(".", 1)[0] + ".E0.txt")
+
+
+def _is_nuclear(name):
+    try:
+        int(name[3:])
+    except ValueError:
+        return False
+    return True
 
 
 def filter_overlap(target, query, gap):
     """
         Indicate hits that are covered by other, higher scoring hits.
         Adds an extra column, "qual". 0 = removed, 1 = retained
+        A hit on a nuclear chromosome is removed when a higher scoring hit of the same
+        query sequence contains it on the same chromosome, or overlaps it on another.
+        The hits are ordered by score, and both rules are answered for all hits at once
+        by searching the positive-strand intervals of the higher scoring hits.
     """
     filename = "last{}_T{}_Q{}.E0.txt".format(gap, target, query)
-    df = pd.read_csv(filename, comment="#", header=0, delim_whitespace=True)
-    split_contig = {}
-    df["qual"] = np.repeat(1, len(df))
-    for (index, row) in df.iterrows():
-        # Only consider the Nuclear chromosomes
-        try:
-            rank = int(row["name1"][3:])
-        except ValueError:
-            row["qual"] = -1
-            continue
-        df1 = df[df["name2"] == row["name2"]]
-        zstart, zend = row["start2"], row["start2"] + row["alnSize2"]
-        if row["strand2"] == "-":
-            zstart, zend = row["seqSize2"] - zend, row["seqSize2"] - zstart
-        # if current line is lower score and either completely covered, or partly covered and on different chromosome
-        for i1, r1 in df1.iterrows():
-            zs, ze = r1["start2"], r1["start2"] + r1["alnSize2"]
-            if r1["strand2"] == "-":
-                zs, ze = r1["seqSize2"] - ze, r1["seqSize2"] - zs
-            if row["score"] >= r1["score"]:
-                continue
-            if row["name1"] != r1["name1"]:
-                if zs < zend and ze > zstart:
-                    df.loc[index, "qual"] = 0
-            else:
-                if zstart >= zs and zend <= ze:
-                    df.loc[index, "qual"] = 0
-    df.to_csv(filename.rsplit(".", 1)[0] + ".QC.txt", sep="\t", index=None)
+    df = parseLast.read_typed(filename)
+    df["qual"] = np.repeat(1, len(df)).astype(np.int8)
+    score = df["score"].to_numpy()
+    zstart = df["start2"].to_numpy()
+    zend = zstart + df["alnSize2"].to_numpy()
+    minus = (df["strand2"] == "-").to_numpy()
+    seqSize2 = df["seqSize2"].to_numpy()
+    zstart, zend = (
+        np.where(minus, seqSize2 - zend, zstart),
+        np.where(minus, seqSize2 - zstart, zend),
+    )
+    name1, names1 = pd.factorize(df["name1"].astype(str))
+    name2 = pd.factorize(df["name2"].astype(str))[0]
+    pair = name2.astype(np.int64) * max(len(names1), 1) + name1
+    # Only consider the Nuclear chromosomes
+    nuclear = np.array([_is_nuclear(str(name)) for name in names1], dtype=bool)
+    check = nuclear[name1] if len(df) > 0 else np.zeros(0, dtype=bool)
+    # Hits sorted by decreasing score; the hits scoring higher than hit i come first
+    order = np.argsort(-score, kind="stable")
+    prefix = np.searchsorted(-score[order], -score, side="left")
+    lo = min(zstart.min(initial=0), zend.min(initial=0))
+    stride = max(zstart.max(initial=0), zend.max(initial=0)) - lo + 1
 
+    def key(group, pos):
+        # Positions of each query sequence (or sequence pair) in a range of their own
+        return group * stride + (pos - lo)
 
-def main(t, q, g):
-    prepare_last(t, q, g)
+    # Same chromosome: a higher scoring hit starts at or before and ends at or after
+    reach = parseLast.prefix_max(
+        prefix,
+        key(pair, zstart)[order],
+        key(pair, zend)[order],
+        key(pair, zstart),
+    )
+    contained = reach >= key(pair, zend)
+    # Other chromosome: hits overlapping on the query, minus those on the same one
+    overlaps = np.zeros(len(df), dtype=np.int64)
+    for group, sign in ((name2, 1), (pair, -1)):
+        starts, ends = key(group, zstart), key(group, zend)
+        overlaps += sign * parseLast.prefix_count(prefix, starts[order], ends)
+        overlaps -= sign * parseLast.prefix_count(
+            prefix, ends[order], starts, strict=False
+        )
+    df.loc[check & (contained | (overlaps > 0)), "qual"] = 0
+    parseLast.write_typed(df, filename.rsplit(".", 1)[0] + ".QC.txt")
+
+
+def main(t, q, g, cache=False):
+    prepare_last(t, q, g, cache)
     filter_overlap(t, q, g)
 
 
 if __name__ == "__main__":
-    if len(sys.argv) < 2:
-        query = [
-            "7002",
-            "7003",
-            "7010",
-            "7011",
-            "7012",
-            "7016",
-            "8001",
-            "8002",
-            "8003",
-            "8005R",
-            "8006",
-            "9006R",
-            "9007R",
-            "9011R",
-            "9012",
-            "9018R",
-            "9016R",
-            "9023R",
-        ]
-        target = "orsadb"
-    elif len(sys.argv) < 3:
-        query = [
-            "7002",
-            "7003",
-            "7010",
-            "7011",
-            "7012",
-            "7016",
-            "8001",
-            "8002",
-            "8003",
-            "8005R",
-            "8006",
-            "9006R",
-            "9007R",
-            "9011R",
-            "9012",
-            "9018R",
-            "9016R",
-            "9023R",
-        ]
-        target = sys.argv[1]
-    else:
-        query = [sys.argv[2]]
-        target = sys.argv[1]
+    parser = argparse.ArgumentParser()
+    parser.add_argument("target", nargs="?", default="orsadb", help="Target [orsadb]")
+    parser.add_argument("query", nargs="?", help="Query [all of QUERIES]")
+    parser.add_argument(
+        "-C",
+        "--cache",
+        action="store_true",
+        default=False,
+        help="Keep the parsed file in a '<infile>.cache' directory and reuse it",
+    )
+    args = parser.parse_args()
+    query = QUERIES if args.query is None else [args.query]
     gap = "gap"
     for q in query:
         try:
-            main(target, q, gap)
-        except:
-            pass
+            main(args.target, q, gap, args.cache)
+        except Exception as err:
+            sys.stderr.write("Sample [{}] failed: {}\n".format(q, err))
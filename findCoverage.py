@@ -2,11 +2,28 @@
 
 """
 Calculate the coverage at each position for the target sequence
-Only recommended for targets less than 10kb.
+The depth of each target is the running sum of +1 at every hit start and -1 at every
+hit end, and is written as a bedGraph with one line per run of equal depth.
+The depths are kept as memory-mapped uint16/uint32 arrays in the sidecar cache of the
+input ('<file>.cache/depth-<idpct>-<covpct>/'), built and read in blocks of BLOCKSIZE
+positions, so the memory used does not grow with the length of the targets.
+A cached store is reused, so windowed summaries ('--windows') and region queries
+('--region') of a file do not read the alignments again.
 """
 
+import argparse
+import os
+import shutil
 import sys
+import numpy as np
 import pandas as pd
+import lastio
+import parseLast
+
+# Positions of a depth array handled at a time
+BLOCKSIZE = 1 << 22
+# Columns read from the alignments
+USECOLS = ["name1", "start1", "end1", "seqSize1", "idpct", "covpct"]
 
 
 def roundup(x, n):
@@ -14,35 +31,292 @@ def roundup(x, n):
     return x if x % N == 0 else x + N - x % N
 
 
-def calc_coverage(filename):
+def depth_dtype(hits):
+    """ Smallest unsigned type that holds the depth of 'hits' hits """
+    return np.uint16 if hits <= np.iinfo(np.uint16).max else np.uint32
+
+
+def fill_depth(depth, starts, ends, blocksize=BLOCKSIZE):
     """
+    Writes the depth of hits into 'depth' (e.g. a memory-mapped array), one block at
+    a time
+    :param starts: Start positions of the hits (0-based)
+    :param ends: End positions of the hits (exclusive)
     """
-    print("Reading {}".format(filename))
-    df = pd.read_table(
-        filename, comment="#", header=0, delim_whitespace=True, error_bad_lines=False
-    )
-    cov = {}
-    for (index, row) in df.iterrows():
-        if row['idpct'] < 100 or row['covpct'] < 50:
-            continue
-        if row["name1"] not in cov:
-            cov[row["name1"]] = [0] * row['seqSize1']
-        for pos in range(row['start1'], row['end1']):
-            cov[row['name1']][pos] += 1
-    outputname = '{}.coverage.txt'.format(filename.rsplit('.', 1)[0])
-    with open(outputname, 'w') as fout:
-        for target, coverage in cov.items():
-            for pos, c in enumerate(coverage):
-                fout.write('{}\t{}\t{}\n'.format(target, pos, c))
-
-
-def main():
-    for filename in sys.argv[1:]:
+    size = len(depth)
+    starts = np.sort(np.clip(starts, 0, size))
+    ends = np.sort(np.clip(ends, 0, size))
+    for lo in range(0, size, blocksize):
+        hi = min(lo + blocksize, size)
+        s0, s1 = np.searchsorted(starts, [lo, hi])
+        e0, e1 = np.searchsorted(ends, [lo, hi])
+        # Hits starting before the block and still open
+        carry = s0 - e0
+        diff = np.bincount(starts[s0:s1] - lo, minlength=hi - lo) - np.bincount(
+            ends[e0:e1] - lo, minlength=hi - lo
+        )
+        depth[lo:hi] = carry + np.cumsum(diff)
+
+
+def coverage_depth(starts, ends, size):
+    """
+    Depth at each position of a sequence
+    :param starts: Start positions of the hits (0-based)
+    :param ends: End positions of the hits (exclusive)
+    :param size: Length of the sequence
+    """
+    depth = np.zeros(size, dtype=depth_dtype(len(starts)))
+    fill_depth(depth, starts, ends)
+    return depth
+
+
+def depth_runs(depth):
+    """
+    Run-length encodes a depth array
+    :return: (starts, ends, values) of the runs of equal depth
+    """
+    bounds = np.flatnonzero(np.diff(depth)) + 1
+    starts = np.concatenate(([0], bounds))
+    ends = np.concatenate((bounds, [len(depth)]))
+    return starts, ends, depth[starts]
+
+
+def iter_runs(depth, start=0, end=None, blocksize=BLOCKSIZE):
+    """
+    Run-length encodes depth[start:end] one block at a time
+    A run crossing into the next block is held back and given whole with that block.
+    :return: Iterator of (starts, ends, values) arrays
+    """
+    end = len(depth) if end is None else min(end, len(depth))
+    run_start = start
+    for lo in range(start, end, blocksize):
+        hi = min(lo + blocksize, end)
+        starts, ends, values = depth_runs(np.asarray(depth[lo:hi]))
+        starts += lo
+        ends += lo
+        starts[0] = run_start
+        if hi < end and depth[hi] == values[-1]:
+            run_start = starts[-1]
+            starts, ends, values = starts[:-1], ends[:-1], values[:-1]
+        else:
+            run_start = hi
+        yield starts, ends, values
+
+
+def write_bedgraph(fout, name, depth, start=0, end=None):
+    for starts, ends, values in iter_runs(depth, start, end):
+        fout.writelines(
+            "{}\t{}\t{}\t{}\n".format(name, s, e, v)
+            for s, e, v in zip(starts.tolist(), ends.tolist(), values.tolist())
+        )
+
+
+def blocksize_for(window):
+    """ Largest multiple of 'window' not above BLOCKSIZE """
+    return max(BLOCKSIZE // window, 1) * window
+
+
+def window_summary(depth, window, start=0, end=None, min_depth=1):
+    """
+    Summarizes depth[start:end] in windows of 'window' positions
+    :return: DataFrame with the start and end of each window, the mean depth, the
+        fraction of positions with a depth of at least 'min_depth', and the number of
+        runs of zero depth in the window
+    """
+    end = len(depth) if end is None else min(end, len(depth))
+    step = blocksize_for(window)
+    parts = []
+    for lo in range(start, end, step):
+        hi = min(lo + step, end)
+        block = np.asarray(depth[lo:hi])
+        first = np.arange(0, hi - lo, window)
+        length = np.diff(np.append(first, hi - lo))
+        zero = block == 0
+        # A zero run starts where the previous position is covered, or at a window start
+        zero_start = zero.copy()
+        zero_start[1:] &= ~zero[:-1]
+        zero_start[first] = zero[first]
+        parts.append(
+            pd.DataFrame(
+                {
+                    "start": first + lo,
+                    "end": first + lo + length,
+                    "mean": np.add.reduceat(block, first, dtype=np.int64) / length,
+                    "covered": np.add.reduceat(
+                        block >= min_depth, first, dtype=np.int64
+                    )
+                    / length,
+                    "zero_runs": np.add.reduceat(zero_start, first, dtype=np.int64),
+                }
+            )
+        )
+    if len(parts) == 0:
+        return pd.DataFrame(columns=["start", "end", "mean", "covered", "zero_runs"])
+    return pd.concat(parts, ignore_index=True)
+
+
+class CoverageStore(object):
+    """
+    Depth of every target of an alignment table, counting the hits that pass the
+    'idpct' and 'covpct' thresholds.
+    The depths are memory-mapped arrays in the sidecar cache of the table, see 'open',
+    or arrays in memory if the cache cannot be written.
+    """
+
+    def __init__(self, names, depths):
+        self.names = list(names)
+        self.depths = dict(zip(self.names, depths))
+
+    @staticmethod
+    def kind(idpct, covpct):
+        return "depth-{:g}-{:g}".format(idpct, covpct)
+
+    @classmethod
+    def open(cls, filename, idpct=100, covpct=50):
+        """ Maps in the cached depths of a file, building them if missing or stale """
+        cached = lastio.load_cache(filename, cls.kind(idpct, covpct))
+        if cached is None:
+            return cls.build(filename, idpct, covpct)
+        meta, columns = cached
+        return cls(meta["names"], [columns[col] for col in meta["columns"]])
+
+    @classmethod
+    def build(cls, filename, idpct=100, covpct=50):
+        """ Reads the hits of a file and writes their depths to its sidecar cache """
+        sys.stderr.write("Reading {}\n".format(filename))
+        df = parseLast.read_typed(filename, usecols=USECOLS, skip_bad=True)
+        df = df[(df["idpct"] >= idpct) & (df["covpct"] >= covpct)]
+        codes, targets = pd.factorize(df["name1"].astype(str))
+        targets = targets.tolist()
+        # Hits grouped by target with one sort, each target a slice
+        order = np.argsort(codes, kind="stable")
+        bounds = np.searchsorted(codes[order], np.arange(len(targets) + 1))
+        starts = df["start1"].to_numpy()[order]
+        ends = df["end1"].to_numpy()[order]
+        sizes = df["seqSize1"].to_numpy()[order]
+        kind = cls.kind(idpct, covpct)
+        tmpdir = None
+        try:
+            tmpdir = lastio.new_cache(filename, kind)
+            columns = []
+            for ind in range(len(targets)):
+                lo, hi = bounds[ind], bounds[ind + 1]
+                column = "depth{}".format(ind)
+                depth = lastio.open_column(
+                    tmpdir, column, depth_dtype(hi - lo), int(sizes[lo])
+                )
+                fill_depth(depth, starts[lo:hi], ends[lo:hi])
+                depth.flush()
+                del depth
+                columns.append(column)
+            meta = {"names": targets, "idpct": idpct, "covpct": covpct}
+            lastio.commit_cache(filename, kind, tmpdir, columns, meta)
+            return cls.open(filename, idpct, covpct)
+        except OSError as err:
+            # E.g. a read-only directory or a full disk, the depths are kept in memory
+            cachedir = os.path.join(lastio.cache_path(filename), kind)
+            sys.stderr.write("Unable to write cache [{}]: {}\n".format(cachedir, err))
+            if tmpdir is not None:
+                shutil.rmtree(tmpdir, ignore_errors=True)
+        depths = [
+            coverage_depth(starts[lo:hi], ends[lo:hi], int(sizes[lo]))
+            for lo, hi in zip(bounds[:-1].tolist(), bounds[1:].tolist())
+        ]
+        return cls(targets, depths)
+
+    def depth(self, name, start=0, end=None):
+        """ Depth of a region of a target, as a memory-mapped array """
+        return self.depths[name][start:end]
+
+    def regions(self, region=None):
+        """
+        Lists the regions to report
+        :param region: 'name', 'name:start-end' (0-based, end exclusive) or None for
+            all targets
+        :return: List of (name, start, end)
+        """
+        if region is None:
+            return [(name, 0, len(self.depths[name])) for name in self.names]
+        name, _, span = region.partition(":")
+        if name not in self.depths:
+            sys.stderr.write("No hits on target [{}]\n".format(name))
+            sys.exit(1)
+        size = len(self.depths[name])
+        if span == "":
+            return [(name, 0, size)]
+        start, end = span.replace(",", "").split("-")
+        return [(name, max(int(start), 0), min(int(end), size))]
+
+
+def write_windows(fout, store, regions, window, min_depth=1):
+    fout.write("name\tstart\tend\tmean\tdepth>={}\tzero_runs\n".format(min_depth))
+    for name, start, end in regions:
+        summary = window_summary(store.depths[name], window, start, end, min_depth)
+        fout.writelines(
+            "{}\t{}\t{}\t{:.2f}\t{:.4f}\t{}\n".format(name, *row)
+            for row in summary.itertuples(index=False)
+        )
+
+
+def calc_coverage(filename, args):
+    """
+    Writes the depth of the hits passing the thresholds to
+    '<filename>.coverage.bedGraph', and a summary per window size to
+    '<filename>.coverage.<window>.txt'.
+    With a region, only that region is written, to stdout.
+    """
+    store = CoverageStore.open(filename, args.idpct, args.covpct)
+    regions = store.regions(args.region)
+    windows = [int(w) for w in args.windows.split(",") if w != ""]
+    base = filename.rsplit(".", 1)[0]
+    if args.region is not None:
+        for window in windows:
+            write_windows(sys.stdout, store, regions, window, args.min_depth)
+        if len(windows) == 0:
+            for name, start, end in regions:
+                write_bedgraph(sys.stdout, name, store.depths[name], start, end)
+        return
+    with open("{}.coverage.bedGraph".format(base), "w") as fout:
+        for name, start, end in regions:
+            write_bedgraph(fout, name, store.depths[name], start, end)
+    for window in windows:
+        with open("{}.coverage.{}.txt".format(base, window), "w") as fout:
+            write_windows(fout, store, regions, window, args.min_depth)
+
+
+def main(args):
+    for filename in args.infiles:
         try:
-            calc_coverage(filename)
-        except pd.io.common.EmptyDataError:
+            calc_coverage(filename, args)
+        except pd.errors.EmptyDataError:
             pass
 
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser()
+    parser.add_argument("infiles", nargs="+", help="Tables written by parseLast")
+    parser.add_argument(
+        "--idpct", type=float, default=100, help="Minimum identity of a hit [100]"
+    )
+    parser.add_argument(
+        "--covpct", type=float, default=50, help="Minimum query coverage of a hit [50]"
+    )
+    parser.add_argument(
+        "-w",
+        "--windows",
+        default="",
+        help="Window sizes to summarize, e.g. 1000,10000,100000",
+    )
+    parser.add_argument(
+        "-m",
+        "--min-depth",
+        type=int,
+        default=1,
+        help="Depth counted as covered in the window summaries [1]",
+    )
+    parser.add_argument(
+        "-r",
+        "--region",
+        help="Only report this target or region ('name:start-end') to stdout",
+    )
+    main(parser.parse_args())
@@ -1,5 +1,6 @@
 #! /usr/bin/env python
 
+import argparse
 import sys
 import pandas as pd
 import matplotlib.pyplot as plt
@@ -7,32 +8,20 @@ import numpy as np
 import matplotlib.colors as colors
 import matplotlib.cm as cm
 import matplotlib.patches as patches
+import parseLast
 
+# Queries run when none is given
+QUERIES = ["7002", "7011", "8001", "9011R", "9018R", "8006", "9023R"]
 
-def locate_splits(target, query, gap):
+
+def locate_splits(target, query, gap, cache=False):
     """
         Assigns chromosome location to each query contig
+        The input is read with the types of 'parseLast.SCHEMA', and kept in a sidecar
+        cache when 'cache' is set.
     """
     filename = "last{}_T{}_Q{}.E0.QC.txt".format(gap[0:3], target, query)
-    names = [
-        "score",
-        "name1",
-        "start1",
-        "alnSize1",
-        "strand1",
-        "seqSize1",
-        "name2",
-        "start2",
-        "alnSize2",
-        "strand2",
-        "seqSize2",
-        "blocks",
-        "EG",
-        "E",
-        "qual",
-    ]
-    df = pd.read_csv(filename, comment="#", header=0, delim_whitespace=True)
-    fig, axes = plt.subplots(1, 1, figsize=(20, 20))
+    df = parseLast.read_typed(filename, cache=cache)
     split_contig = {}
     for (index, row) in df.iterrows():
         if row["qual"] != 1:
@@ -57,17 +46,23 @@ def locate_splits(target, query, gap):
                 fout.write("{}\t{}\t{}\t{}\n".format(name2, name1, length, len(hits)))
 
 
-def main(t, q, g):
-    locate_splits(t, q, g)
+def main(t, q, g, cache=False):
+    locate_splits(t, q, g, cache)
 
 
 if __name__ == "__main__":
-    if len(sys.argv) < 3:
-        query = ["7002", "7011", "8001", "9011R", "9018R", "8006", "9023R"]
-        target = "orsadb"
-    else:
-        query = [sys.argv[2]]
-        target = sys.argv[1]
+    parser = argparse.ArgumentParser()
+    parser.add_argument("target", nargs="?", default="orsadb", help="Target [orsadb]")
+    parser.add_argument("query", nargs="?", help="Query [all of QUERIES]")
+    parser.add_argument(
+        "-C",
+        "--cache",
+        action="store_true",
+        default=False,
+        help="Keep the parsed file in a '<infile>.cache' directory and reuse it",
+    )
+    args = parser.parse_args()
+    query = QUERIES if args.query is None else [args.query]
     gap = "gapped"
     for q in query:
-        main(target, q, gap)
+        main(args.target, q, gap, args.cache)
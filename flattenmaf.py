@@ -1,136 +1,391 @@
 #!/usr/bin/env python
+import argparse
+import contextlib
+import itertools
 import sys
+import numpy as np
+import lastio
 
+# Byte values of the gap character, and of a query base that differs between blocks
+GAP = ord("-")
+CONFLICT = ord("X")
+# Reference positions written at a time by 'printmaf'
+CHUNKSIZE = 1 << 20
 
-def convertmaf(maf):
-    names = []
-    db = {}
-    gapdb = {}
-    ref = True
-    with open(maf, "r") as fin:
-        for line in fin:
-            if line.startswith("#"):
-                continue
-            line_l = line.strip().split()
-            if len(line_l) < 7:
-                continue
-            if line_l[0] == "a":
-                continue
-            code1, name1, start1, end1, strand1, size1, seq1 = line_l
-            code2, name2, start2, end2, strand2, size2, seq2 = next(fin).strip().split()
-            name2 = name2.split("_")[0]
-            if name1 not in names:
-                names.append(name1)
-            if name2 not in names:
-                names.append(name2)
-            pos = int(start1)
-            gap = 0
-            gapseq = ""
-            for ind, base1 in enumerate(seq1):
-                if base1 != "-":
-                    if len(gapseq) > 0:
-                        gapdb[pos][name2] = gapseq
-                    gap, gapseq = 0, ""
-                    pos += 1
-                    if pos not in db:
-                        db[pos] = {}
-                    db[pos][name1] = base1
-                    if name2 in db[pos]:
-                        if db[pos][name2] != seq2[ind]:
-                            db[pos][name2] = "X"
-                    else:
-                        db[pos][name2] = seq2[ind]
-                else:
-                    if pos not in gapdb:
-                        gapdb[pos] = {}
-                    gapseq += seq2[ind]
-    return db, gapdb, int(size1), names
-
-
-def convertmaf2(maf):
-    names = []
-    db = {}
-    gapdb = {}
-    ref = True
-    with open(maf, "r") as fin:
-        for line in fin:
-            if line.startswith("#"):
-                continue
-            line_l = line.strip().split()
-            if len(line_l) < 7:
+
+class Projection(object):
+    """
+    Bases of every sample at each reference position, and the bases inserted between
+    the reference positions.
+    Each sample has a byte array over the reference positions, 0 where it has no base.
+    Inserted bases are packed into one buffer, with a side table of (pos, sample,
+    offset, length) rows for the bases inserted after reference position 'pos'.
+    Positions are counted from 'origin'. With 'clip' the arrays keep their 'size' and
+    positions outside it are dropped, otherwise the arrays grow as needed.
+    """
+
+    def __init__(self, size=0, origin=0, clip=False):
+        self.names = []
+        self.rows = {}
+        self.bases = []
+        self.size = size
+        self.origin = origin
+        self.clip = clip
+        self.ins_pos = []
+        self.ins_sample = []
+        self.ins_offset = []
+        self.ins_length = []
+        self.buffer = bytearray()
+
+    def row(self, name):
+        """ Index of a sample, adding it when first seen """
+        if name not in self.rows:
+            self.rows[name] = len(self.names)
+            self.names.append(name)
+            self.bases.append(np.zeros(self.size, dtype=np.uint8))
+        return self.rows[name]
+
+    def reserve(self, size):
+        """ Grows the base arrays to at least 'size' positions """
+        if size <= self.size or self.clip:
+            return
+        size = max(size, 2 * self.size)
+        for ind, bases in enumerate(self.bases):
+            grown = np.zeros(size, dtype=np.uint8)
+            grown[: len(bases)] = bases
+            self.bases[ind] = grown
+        self.size = size
+
+    def _inside(self, pos):
+        return (pos >= 0) & (pos < self.size)
+
+    def add_block(self, name1, start1, seq1, others):
+        """
+        Projects one block onto its reference (first) sequence
+        The i-th reference base of the block goes to position start1 + 1 + i.
+        A query base that differs from the one placed there by an earlier block is
+        replaced by 'X'.
+        The query bases aligned to reference gaps are inserted after the reference
+        base before them, and are dropped at the end of the block.
+        :param seq1: Aligned reference sequence as bytes
+        :param others: List of (name, aligned sequence as bytes) of the other sequences
+        """
+        s1 = np.frombuffer(seq1, dtype=np.uint8)
+        ref = s1 != GAP
+        cols = np.flatnonzero(ref)
+        pos = start1 + 1 + np.arange(len(cols)) - self.origin
+        self.reserve(start1 + 1 + len(cols) - self.origin)
+        if self.clip:
+            inside = self._inside(pos)
+            cols, pos = cols[inside], pos[inside]
+        row1 = self.row(name1)
+        self.bases[row1][pos] = s1[cols]
+        rows = [self.row(name2) for name2, seq2 in others]
+        for row2, (name2, seq2) in zip(rows, others):
+            query = self.bases[row2]
+            old, new = query[pos], np.frombuffer(seq2, dtype=np.uint8)[cols]
+            query[pos] = np.where((old == 0) | (old == new), new, CONFLICT)
+        if ref.all():
+            return
+        # Runs of reference gaps that are followed by a reference base
+        gaps = np.flatnonzero(~ref)
+        first = gaps[np.r_[True, np.diff(gaps) > 1]]
+        last = gaps[np.r_[np.diff(gaps) > 1, True]] + 1
+        keep = last < len(s1)
+        first, last = first[keep], last[keep]
+        # The reference bases before a run give its position
+        before = np.cumsum(ref)[first]
+        ins_pos = start1 + before - self.origin
+        if self.clip:
+            inside = self._inside(ins_pos)
+            ins_pos, first, last = ins_pos[inside], first[inside], last[inside]
+        if len(first) == 0:
+            return
+        # Only the inserted bases are kept, packed one run after the other
+        length = last - first
+        packed = np.cumsum(length) - length
+        cols = _runs(first, length)
+        for row2, (name2, seq2) in zip(rows, others):
+            self.ins_pos.append(ins_pos)
+            self.ins_sample.append(np.repeat(row2, len(first)))
+            self.ins_offset.append(len(self.buffer) + packed)
+            self.ins_length.append(length)
+            self.buffer += np.frombuffer(seq2, dtype=np.uint8)[cols].tobytes()
+
+    def inserts(self):
+        """
+        Rows of the insert table, keeping the last insert of a sample at a position
+        :return: (pos, sample, offset, length) arrays, sorted by position and sample
+        """
+        pos = np.concatenate(self.ins_pos + [np.zeros(0, dtype=np.int64)])
+        sample = np.concatenate(self.ins_sample + [np.zeros(0, dtype=np.int64)])
+        offset = np.concatenate(self.ins_offset + [np.zeros(0, dtype=np.int64)])
+        length = np.concatenate(self.ins_length + [np.zeros(0, dtype=np.int64)])
+        if len(pos) == 0:
+            return pos, sample, offset, length
+        key = pos * max(len(self.names), 1) + sample
+        order = np.argsort(key, kind="stable")
+        key = key[order]
+        last = np.r_[key[1:] != key[:-1], True]
+        order = order[last]
+        return pos[order], sample[order], offset[order], length[order]
+
+
+def parse_region(region):
+    """
+    :param region: 'name:start-end', 0-based and end exclusive
+    :return: (name, start, end)
+    """
+    name, _, span = region.rpartition(":")
+    start, end = span.replace(",", "").split("-")
+    return name, int(start), int(end)
+
+
+def iter_blocks(fin, region=None):
+    """
+    Reads the alignment blocks of a MAF file
+    Only the 's' lines are used; 'i', 'e' and 'q' lines and comments are skipped.
+    :param region: (name, start, end) of the reference sequence. Blocks whose first
+        sequence does not overlap it are skipped without splitting their sequences.
+    :return: Iterator of blocks, each a list of the (name, start, size, strand,
+        srcSize, text) of its sequences, the reference first
+    """
+    block = []
+    skip = False
+    for line in fin:
+        if line.startswith("a") or len(line.strip()) == 0:
+            if len(block) > 0:
+                yield block
+            block, skip = [], False
+            continue
+        if skip or not line.startswith("s"):
+            continue
+        if len(block) == 0 and region is not None:
+            name, start, size = line.split(None, 4)[1:4]
+            start, size = int(start), int(size)
+            # The block projects onto positions start + 1 to start + size, and can
+            # insert bases after position start
+            if name != region[0] or start > region[2] or start + size < region[1] + 1:
+                skip = True
                 continue
-            if line_l[0] == "a":
+        code, name, start, size, strand, srcsize, text = line.split()
+        block.append((name, int(start), int(size), strand, int(srcsize), text))
+    if len(block) > 0:
+        yield block
+
+
+class MafIndex(object):
+    """
+    Offsets of the blocks of a MAF file, by the interval of their reference sequence.
+    The blocks of each reference name are sorted by start, with the largest end seen
+    so far, so the blocks overlapping a region are found with two binary searches.
+    The index is kept in the sidecar cache of the file and rebuilt when the file
+    changes. Offsets of BGZF files are virtual offsets, see 'lastio.iter_lines'.
+    """
+
+    KIND = "maf-index"
+
+    def __init__(self, names, columns):
+        self.names = {name: ind for ind, name in enumerate(names)}
+        self.code = columns["code"]
+        self.start = columns["start"]
+        self.end = columns["end"]
+        self.reach = columns["reach"]
+        self.offset = columns["offset"]
+        self.rank = columns["rank"]
+
+    @classmethod
+    def open(cls, maf):
+        """ Maps in the index of a MAF file, building it if missing or stale """
+        cached = lastio.load_cache(maf, cls.KIND)
+        if cached is None:
+            return cls.build(maf)
+        meta, columns = cached
+        return cls(meta["names"], columns)
+
+    @staticmethod
+    def scan(maf):
+        """
+        Finds the blocks of a MAF file in one pass, as 'iter_blocks' reads them
+        :return: Iterator of (offset, name, start, size) of the reference of each block
+        """
+        offset = None
+        found = False
+        for pos, line in lastio.iter_lines(maf):
+            if line.startswith(b"a") or len(line.strip()) == 0:
+                offset = pos if line.startswith(b"a") else None
+                found = False
                 continue
-            code1, name1, start1, end1, strand1, size1, seq1 = line_l
-            code2, name2, start2, end2, strand2, size2, seq2 = next(fin).strip().split()
-            name2 = name2.split("_")[0]
-            if name1 not in names:
-                names.append(name1)
-            if name2 not in names:
-                names.append(name2)
-            pos = int(start1)
-            gap = 0
-            gapseq = ""
-            for ind, base1 in enumerate(seq1):
-                if base1 != "-":
-                    if len(gapseq) > 0:
-                        gapdb[pos][name2] = gapseq
-                    gap, gapseq = 0, ""
-                    pos += 1
-                    if pos not in db:
-                        db[pos] = {}
-                    db[pos][name1] = base1
-                    if name2 in db[pos]:
-                        if db[pos][name2] != seq2[ind]:
-                            db[pos][name2] = "X"
-                    else:
-                        db[pos][name2] = seq2[ind]
+            if offset is None:
+                offset = pos
+            if not found and line.startswith(b"s"):
+                name, start, size = line.split(None, 4)[1:4]
+                yield offset, name.decode(), int(start), int(size)
+                found = True
+
+    @classmethod
+    def build(cls, maf):
+        """ Scans a MAF file and writes its index to the sidecar cache """
+        names = {}
+        code, start, size, offset = [], [], [], []
+        for pos, name, start1, size1 in cls.scan(maf):
+            code.append(names.setdefault(name, len(names)))
+            start.append(start1)
+            size.append(size1)
+            offset.append(pos)
+        code = np.array(code, dtype=np.int64)
+        start = np.array(start, dtype=np.int64)
+        end = start + np.array(size, dtype=np.int64)
+        order = np.lexsort((start, code))
+        code, start, end = code[order], start[order], end[order]
+        # Largest end among the blocks of the same name starting at or before each
+        reach = end.copy()
+        for ind in range(len(names)):
+            lo, hi = np.searchsorted(code, [ind, ind + 1])
+            reach[lo:hi] = np.maximum.accumulate(end[lo:hi])
+        columns = {
+            "code": code,
+            "start": start,
+            "end": end,
+            "reach": reach,
+            "offset": np.array(offset, dtype=np.int64)[order],
+            "rank": order.astype(np.int64),
+        }
+        lastio.save_cache(maf, cls.KIND, columns, {"names": list(names)})
+        return cls(list(names), columns)
+
+    def query(self, name, start, end):
+        """
+        Finds the blocks that 'iter_blocks' keeps for a region
+        :return: (rank, offset) of the blocks, in the order of the file
+        """
+        if name not in self.names:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        lo, hi = np.searchsorted(self.code, [self.names[name], self.names[name] + 1])
+        # Blocks with start <= end and start + size >= start + 1, see 'iter_blocks'
+        first = lo + np.searchsorted(self.reach[lo:hi], start + 1)
+        last = lo + np.searchsorted(self.start[lo:hi], end, side="right")
+        found = first + np.flatnonzero(self.end[first:last] >= start + 1)
+        order = np.argsort(self.rank[found])
+        return self.rank[found][order], self.offset[found][order]
+
+
+def read_blocks(maf, index, window):
+    """
+    Reads the blocks overlapping a window, seeking to each run of consecutive blocks
+    :param window: (name, start, end) of the reference sequence
+    """
+    rank, offset = index.query(*window)
+    if rank.size == 0:
+        return
+    runs = np.flatnonzero(np.r_[True, np.diff(rank) != 1, True])
+    with lastio.OffsetReader(maf) as reader:
+        for first, last in zip(runs[:-1].tolist(), runs[1:].tolist()):
+            lines = (line.decode() for line in reader.lines(int(offset[first])))
+            for block in itertools.islice(iter_blocks(lines), last - first):
+                yield block
+
+
+def convertmaf2(maf, region=None):
+    """
+    Projects the blocks of a MAF file onto the reference (first) sequence of each
+    With a region, plain and BGZF files are read through a 'MafIndex'.
+    :param region: 'name:start-end' of the reference to project, instead of all of it
+    :return: (Projection, number of positions to write)
+    """
+    window = None if region is None else parse_region(region)
+    proj = None
+    size1 = None
+    with contextlib.ExitStack() as stack:
+        if window is not None and lastio.file_compression(maf) in (None, "bgzf"):
+            blocks = read_blocks(maf, MafIndex.open(maf), window)
+        else:
+            blocks = iter_blocks(stack.enter_context(lastio.open_file(maf)), window)
+        for block in blocks:
+            name1, start1, _, _, size1, seq1 = block[0]
+            if proj is None:
+                if window is None:
+                    proj = Projection(size1 + 1)
                 else:
-                    if pos not in gapdb:
-                        gapdb[pos] = {}
-                    gapseq += seq2[ind]
-    return db, gapdb, int(size1), names
-
-
-def printmaf(db, gapdb, size, names):
-    out = {}
-    for name in names:
-        out[name] = ""
-    for pos in range(0, size):
-        try:
-            seq = db[pos]
-        except KeyError:
-            for name in names:
-                out[name] += "-"
-            continue
-        for name in names:
-            try:
-                base = seq[name]
-            except KeyError:
-                base = "-"
-            out[name] += base
-        if pos in gapdb:
-            gap = gapdb[pos]
-            gaplen = 0
-            # Find the longest inserted segment
-            for name, gapseq in gap.items():
-                gaplen = max(gaplen, len(gapseq))
-            for name in out:
-                try:
-                    gapseq = gap[name]
-                    out[name] += gapseq.ljust(gaplen, "-")
-                except KeyError:
-                    out[name] += "-" * gaplen
-    for name, seq in out.items():
-        sys.stdout.write(">{}\n{}\n".format(name, seq))
-
-
-def main():
-    maffile = sys.argv[1]
-    # db, gapdb, size, names = convertmaf(maffile)
-    db, gapdb, size, names = convertmaf2(maffile)
-    printmaf(db, gapdb, size, names)
+                    # Positions start + 1 to end hold the bases of the region
+                    start, end = window[1], min(window[2], size1)
+                    proj = Projection(max(end - start, 0), start + 1, clip=True)
+            others = [(name.split("_")[0], seq.encode()) for name, *_, seq in block[1:]]
+            proj.reserve(size1 + 1)
+            proj.add_block(name1, start1, seq1.encode(), others)
+    if window is not None:
+        if proj is None:
+            proj = Projection(window[2] - window[1], window[1] + 1, clip=True)
+        return proj, proj.size
+    return proj, size1
+
+
+def _runs(starts, lengths):
+    """ Indices of the runs of 'lengths' positions from 'starts', concatenated """
+    within = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    return np.repeat(starts, lengths) + within
+
+
+def printmaf(proj, size, fout=None, chunk=CHUNKSIZE):
+    """
+    Writes the projection as FASTA, one sequence per sample
+    Each sequence is assembled and written 'chunk' reference positions at a time,
+    so only one chunk of output is held in memory. The insert columns are kept for
+    the positions with inserts only.
+    :param fout: Binary file to write to [sys.stdout.buffer]
+    """
+    fout = sys.stdout.buffer if fout is None else fout
+    pos, sample, offset, length = proj.inserts()
+    # Inserts are only written after positions where some sample has a base
+    keep = pos < size
+    covered = np.zeros(int(keep.sum()), dtype=bool)
+    for bases in proj.bases:
+        covered |= bases[pos[keep]] != 0
+    keep[keep] = covered
+    pos, sample, offset, length = (col[keep] for col in (pos, sample, offset, length))
+    # Columns after each position with inserts taken up by the longest insert there
+    ins_cols, first = np.unique(pos, return_index=True)
+    widths = np.maximum.reduceat(length, first) if len(first) > 0 else length
+    # Inserts grouped by sample, in order of position
+    order = np.argsort(sample, kind="stable")
+    pos, sample, offset, length = (col[order] for col in (pos, sample, offset, length))
+    bounds = np.searchsorted(sample, np.arange(len(proj.names) + 1))
+    buffer = np.frombuffer(bytes(proj.buffer), dtype=np.uint8)
+    for row, name in enumerate(proj.names):
+        fout.write(">{}\n".format(name).encode())
+        bases = proj.bases[row]
+        lo_ins, hi_ins = bounds[row], bounds[row + 1]
+        for lo in range(0, size, chunk):
+            hi = min(lo + chunk, size)
+            gaps = np.zeros(hi - lo, dtype=np.int64)
+            g0, g1 = np.searchsorted(ins_cols, [lo, hi])
+            gaps[ins_cols[g0:g1] - lo] = widths[g0:g1]
+            # Output column of each reference position of the chunk
+            column = np.arange(hi - lo) + np.cumsum(gaps) - gaps
+            out = np.full(hi - lo + int(gaps.sum()), GAP, dtype=np.uint8)
+            part = bases[lo:hi]
+            placed = np.flatnonzero(part)
+            out[column[placed]] = part[placed]
+            first, last = lo_ins + np.searchsorted(pos[lo_ins:hi_ins], [lo, hi])
+            lengths = length[first:last]
+            out[_runs(column[pos[first:last] - lo] + 1, lengths)] = buffer[
+                _runs(offset[first:last], lengths)
+            ]
+            fout.write(out.tobytes())
+        fout.write(b"\n")
+
+
+def main(args):
+    proj, size = convertmaf2(args.maffile, args.region)
+    printmaf(proj, size)
 
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser()
+    parser.add_argument("maffile", help="MAF file")
+    parser.add_argument(
+        "-r",
+        "--region",
+        help="Only flatten this region of the reference ('name:start-end', 0-based)",
+    )
+    main(parser.parse_args())
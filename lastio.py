@@ -0,0 +1,501 @@
+#!/usr/bin/env python3
+"""
+Module Docstring
+Shared file handling for the LAST scripts.
+'open_file' reads plain, gzip, BGZF and zstd files, detecting the compression from the
+magic bytes. BGZF blocks are decompressed on a thread pool, and other compressed
+streams are decompressed by a background thread while the caller parses.
+Parsed files can be kept in a binary sidecar directory ('<file>.cache/<kind>/') holding
+one .npy file per column and a JSON file with names and other metadata, where 'kind'
+names the parser that produced the columns.
+The sidecar is only used while the path, size and modification time of the file match.
+'iter_lines' and 'OffsetReader' give random access to plain and BGZF files, using
+virtual offsets for BGZF as in tabix, and 'BgzfWriter' writes BGZF files.
+Large columns can be written in place as memory-mapped arrays with 'new_cache',
+'open_column' and 'commit_cache'.
+"""
+
+__author__ = "Harald Grove"
+__version__ = "0.1.0"
+__license__ = "MIT"
+
+import collections
+import gzip
+import io
+import json
+import os
+import queue
+import shutil
+import struct
+import sys
+import threading
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+CACHE_VERSION = 2
+# Threads used for decompressing BGZF blocks
+THREADS = min(4, os.cpu_count() or 1)
+# Size of the pieces handed over by the background decompression thread
+READSIZE = 1024 * 1024
+# Data held by one BGZF block when writing, as in htslib
+BGZF_BLOCKSIZE = 0xFF00
+# Empty block marking the end of a BGZF file
+BGZF_EOF = bytes.fromhex("1f8b08040000000000ff0600424302001b0003000000000000000000")
+
+
+def detect_compression(head):
+    """
+    Identifies the compression of a file from its first bytes.
+    :return: 'bgzf', 'gzip', 'zstd' or None
+    """
+    if head[:2] == b"\x1f\x8b":
+        # BGZF is gzip with a 'BC' extra field holding the block size
+        if len(head) >= 16 and head[3] & 4 and head[12:14] == b"BC":
+            return "bgzf"
+        return "gzip"
+    if head[:4] == b"\x28\xb5\x2f\xfd":
+        return "zstd"
+    return None
+
+
+def file_compression(filename):
+    with open(filename, "rb") as fin:
+        return detect_compression(fin.read(16))
+
+
+def is_compressed(filename):
+    return file_compression(filename) is not None
+
+
+class BgzfReader(io.RawIOBase):
+    """
+    Reads a BGZF file, decompressing the next blocks on a thread pool
+    while the current one is consumed.
+    """
+
+    def __init__(self, fileobj, threads=THREADS):
+        self.fileobj = fileobj
+        self.pool = ThreadPoolExecutor(threads)
+        self.pending = collections.deque()
+        self.ahead = threads * 4
+        self.data = b""
+        self.pos = 0
+        self.eof = False
+        self.offsets = fileobj.seekable()
+
+    def readable(self):
+        return True
+
+    def _fill(self):
+        while not self.eof and len(self.pending) < self.ahead:
+            coffset = self.fileobj.tell() if self.offsets else None
+            block = _read_block(self.fileobj)
+            if block is None:
+                self.eof = True
+            else:
+                self.pending.append((coffset, self.pool.submit(_inflate, *block)))
+
+    def blocks(self):
+        """ Yields the (file offset, data) of the remaining blocks """
+        while True:
+            self._fill()
+            if len(self.pending) == 0:
+                return
+            coffset, future = self.pending.popleft()
+            yield coffset, future.result()
+
+    def readinto(self, b):
+        while self.pos >= len(self.data):
+            self._fill()
+            if len(self.pending) == 0:
+                return 0
+            self.data = self.pending.popleft()[1].result()
+            self.pos = 0
+        n = min(len(b), len(self.data) - self.pos)
+        b[:n] = self.data[self.pos : self.pos + n]
+        self.pos += n
+        return n
+
+    def close(self):
+        if not self.closed:
+            self.pool.shutdown(wait=True, cancel_futures=True)
+            self.fileobj.close()
+        super().close()
+
+
+def _read_block(fileobj):
+    """ Returns the raw deflate data and size of the next block, or None at the end """
+    header = fileobj.read(12)
+    if len(header) == 0:
+        return None
+    if len(header) < 12 or header[:2] != b"\x1f\x8b":
+        raise OSError("Invalid BGZF block header")
+    xlen = struct.unpack("<H", header[10:12])[0]
+    extra = fileobj.read(xlen)
+    bsize = None
+    ind = 0
+    while ind + 4 <= len(extra):
+        slen = struct.unpack("<H", extra[ind + 2 : ind + 4])[0]
+        if extra[ind : ind + 2] == b"BC":
+            bsize = struct.unpack("<H", extra[ind + 4 : ind + 6])[0]
+        ind += 4 + slen
+    if bsize is None:
+        raise OSError("Gzip member without BGZF block size")
+    rest = fileobj.read(bsize - 11 - xlen)
+    isize = struct.unpack("<I", rest[-4:])[0]
+    return rest[:-8], isize
+
+
+def _inflate(data, isize):
+    out = zlib.decompress(data, -15)
+    if len(out) != isize:
+        raise OSError("BGZF block has wrong uncompressed size")
+    return out
+
+
+class BgzfWriter(io.RawIOBase):
+    """
+    Writes a BGZF file, one block per BGZF_BLOCKSIZE bytes of data, and the empty end
+    of file block when closed.
+    """
+
+    def __init__(self, fileobj, level=6):
+        self.fileobj = fileobj
+        self.level = level
+        self.data = bytearray()
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self.data += b
+        while len(self.data) >= BGZF_BLOCKSIZE:
+            self._write_block(bytes(self.data[:BGZF_BLOCKSIZE]))
+            del self.data[:BGZF_BLOCKSIZE]
+        return len(b)
+
+    def _write_block(self, data):
+        comp = zlib.compressobj(self.level, zlib.DEFLATED, -15)
+        cdata = comp.compress(data) + comp.flush()
+        # Gzip header with the 'BC' extra field holding the block size minus one
+        header = b"\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00BC\x02\x00"
+        self.fileobj.write(header + struct.pack("<H", len(cdata) + 25))
+        self.fileobj.write(cdata + struct.pack("<II", zlib.crc32(data), len(data)))
+
+    def close(self):
+        if not self.closed:
+            if len(self.data) > 0:
+                self._write_block(bytes(self.data))
+            self.fileobj.write(BGZF_EOF)
+            self.fileobj.close()
+        super().close()
+
+
+class ThreadedReader(io.RawIOBase):
+    """ Reads a stream on a background thread, so decompression overlaps with parsing """
+
+    def __init__(self, fileobj, size=READSIZE, ahead=8):
+        self.fileobj = fileobj
+        self.size = size
+        self.queue = queue.Queue(ahead)
+        self.stop = threading.Event()
+        self.data = b""
+        self.pos = 0
+        self.done = False
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def readable(self):
+        return True
+
+    def _run(self):
+        try:
+            while not self.stop.is_set():
+                data = self.fileobj.read(self.size)
+                self.queue.put(data)
+                if len(data) == 0:
+                    break
+        except Exception as err:
+            self.queue.put(err)
+
+    def readinto(self, b):
+        while self.pos >= len(self.data):
+            if self.done:
+                return 0
+            data = self.queue.get()
+            if isinstance(data, Exception):
+                raise data
+            if len(data) == 0:
+                self.done = True
+                return 0
+            self.data, self.pos = data, 0
+        n = min(len(b), len(self.data) - self.pos)
+        b[:n] = self.data[self.pos : self.pos + n]
+        self.pos += n
+        return n
+
+    def close(self):
+        if not self.closed:
+            self.stop.set()
+            while self.thread.is_alive():
+                try:
+                    self.queue.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+            self.fileobj.close()
+        super().close()
+
+
+def _zstd_reader(fileobj):
+    if zstandard is None:
+        raise OSError("Reading zstd files requires the 'zstandard' package")
+    return zstandard.ZstdDecompressor().stream_reader(fileobj, read_across_frames=True)
+
+
+def open_file(filename, mode="r"):
+    """
+    Opens a file for reading or writing, handling compression.
+    When reading, the compression is detected from the magic bytes, and 'filename' may
+    also be an open binary file object such as 'sys.stdin.buffer'.
+    When writing, files ending in '.gz' are gzip-compressed and '.zst' zstd-compressed.
+    :param mode: 'r', 'rb', 'w' or 'wb'
+    """
+    if "w" in mode:
+        return _open_write(filename, mode)
+    if isinstance(filename, str):
+        fin = open(filename, "rb")
+    else:
+        fin = filename
+    if not hasattr(fin, "peek"):
+        fin = io.BufferedReader(fin)
+    kind = detect_compression(fin.peek(16)[:16])
+    if kind is None:
+        raw = fin
+    elif kind == "bgzf":
+        raw = io.BufferedReader(BgzfReader(fin), READSIZE)
+    elif kind == "gzip":
+        raw = io.BufferedReader(ThreadedReader(gzip.GzipFile(fileobj=fin)), READSIZE)
+    else:
+        raw = io.BufferedReader(ThreadedReader(_zstd_reader(fin)), READSIZE)
+    if "b" in mode:
+        return raw
+    return io.TextIOWrapper(raw)
+
+
+def iter_lines(filename):
+    """
+    Reads the lines of a plain or BGZF file with their offsets.
+    For BGZF files the offsets are virtual offsets, the file offset of the block
+    shifted up 16 bits plus the offset within the decompressed block.
+    :return: Iterator of (offset, line as bytes)
+    """
+    with open(filename, "rb") as fin:
+        kind = detect_compression(fin.peek(16)[:16])
+        if kind is None:
+            offset = 0
+            for line in fin:
+                yield offset, line
+                offset += len(line)
+            return
+        if kind != "bgzf":
+            raise OSError("Only plain and BGZF files can be read at offsets")
+        reader = BgzfReader(fin)
+        try:
+            partial, start = b"", None
+            for coffset, data in reader.blocks():
+                pos = 0
+                while pos < len(data):
+                    if start is None:
+                        start = (coffset << 16) | pos
+                    end = data.find(b"\n", pos)
+                    if end < 0:
+                        partial += data[pos:]
+                        break
+                    yield start, partial + data[pos : end + 1]
+                    partial, start, pos = b"", None, end + 1
+            if len(partial) > 0:
+                yield start, partial
+        finally:
+            reader.close()
+
+
+class OffsetReader(object):
+    """
+    Reads lines of a plain or BGZF file from the offsets given by 'iter_lines',
+    keeping the file open between reads. The last BGZF block read is kept, as
+    nearby offsets often share it.
+    """
+
+    def __init__(self, filename):
+        self.fileobj = open(filename, "rb")
+        self.kind = detect_compression(self.fileobj.peek(16)[:16])
+        if self.kind not in (None, "bgzf"):
+            self.fileobj.close()
+            raise OSError("Only plain and BGZF files can be read at offsets")
+        self.cached = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.fileobj.close()
+
+    def _block(self, coffset):
+        """ Returns the data of the block at a file offset, and the offset after it """
+        if self.cached is None or self.cached[0] != coffset:
+            self.fileobj.seek(coffset)
+            block = _read_block(self.fileobj)
+            data = b"" if block is None else _inflate(*block)
+            self.cached = (coffset, data, self.fileobj.tell())
+        return self.cached[1:]
+
+    def lines(self, offset):
+        """ Yields the lines from an offset to the end of the file, as bytes """
+        if self.kind is None:
+            self.fileobj.seek(offset)
+            for line in iter(self.fileobj.readline, b""):
+                yield line
+            return
+        coffset, pos = offset >> 16, offset & 0xFFFF
+        partial = b""
+        while True:
+            data, after = self._block(coffset)
+            if len(data) == 0:
+                break
+            while pos < len(data):
+                end = data.find(b"\n", pos)
+                if end < 0:
+                    partial += data[pos:]
+                    break
+                yield partial + data[pos : end + 1]
+                partial, pos = b"", end + 1
+            coffset, pos = after, 0
+        if len(partial) > 0:
+            yield partial
+
+
+def find_file(filename):
+    """ Returns filename, or a compressed copy ('.gz' or '.zst') if only that exists """
+    if not os.path.exists(filename):
+        for suffix in (".gz", ".zst"):
+            if os.path.exists(filename + suffix):
+                return filename + suffix
+    return filename
+
+
+def _open_write(filename, mode):
+    if filename.endswith(".gz"):
+        return gzip.open(filename, mode if "b" in mode else "wt", compresslevel=6)
+    if filename.endswith(".zst"):
+        if zstandard is None:
+            raise OSError("Writing zstd files requires the 'zstandard' package")
+        fout = zstandard.ZstdCompressor().stream_writer(open(filename, "wb"))
+        return fout if "b" in mode else io.TextIOWrapper(fout)
+    return open(filename, mode)
+
+
+def cache_path(filename):
+    return "{}.cache".format(filename)
+
+
+def _file_key(filename):
+    stat = os.stat(filename)
+    return {
+        "path": os.path.abspath(filename),
+        "size": stat.st_size,
+        "mtime": stat.st_mtime_ns,
+    }
+
+
+def load_cache(filename, kind):
+    """
+    Maps in the cached columns of a file.
+    :param filename: The parsed file, not the cache directory
+    :param kind: Name of the parser that wrote the cache
+    :return: (meta, columns) with memory-mapped arrays, or None if missing or stale
+    """
+    cachedir = os.path.join(cache_path(filename), kind)
+    try:
+        with open(os.path.join(cachedir, "meta.json"), "r") as fin:
+            meta = json.load(fin)
+    except (OSError, ValueError):
+        return None
+    if meta.get("version") != CACHE_VERSION or meta.get("kind") != kind:
+        return None
+    if meta.get("key") != _file_key(filename):
+        return None
+    columns = {}
+    for name in meta["columns"]:
+        colfile = os.path.join(cachedir, "{}.npy".format(name))
+        columns[name] = np.load(colfile, mmap_mode="r")
+    return meta, columns
+
+
+def new_cache(filename, kind):
+    """
+    Starts a new cache that is filled column by column, see 'open_column'.
+    :return: Temporary directory to pass on to 'commit_cache'
+    """
+    cachedir = os.path.join(cache_path(filename), kind)
+    tmpdir = "{}.tmp{}".format(cachedir, os.getpid())
+    shutil.rmtree(tmpdir, ignore_errors=True)
+    os.makedirs(tmpdir)
+    return tmpdir
+
+
+def open_column(tmpdir, name, dtype, size):
+    """ Creates a zero-filled, memory-mapped column of 'size' values in a new cache """
+    colfile = os.path.join(tmpdir, "{}.npy".format(name))
+    return np.lib.format.open_memmap(colfile, mode="w+", dtype=dtype, shape=(size,))
+
+
+def commit_cache(filename, kind, tmpdir, names, meta=None):
+    """
+    Replaces the cache of a file with the columns written to 'tmpdir'.
+    :param names: Names of the columns
+    :param meta: JSON-serializable dict stored alongside the columns
+    """
+    meta = dict(meta or {})
+    meta.update(
+        {
+            "version": CACHE_VERSION,
+            "kind": kind,
+            "key": _file_key(filename),
+            "columns": list(names),
+        }
+    )
+    cachedir = os.path.join(cache_path(filename), kind)
+    with open(os.path.join(tmpdir, "meta.json"), "w") as fout:
+        json.dump(meta, fout)
+    if os.path.isdir(cachedir):
+        shutil.rmtree(cachedir)
+    os.rename(tmpdir, cachedir)
+
+
+def save_cache(filename, kind, columns, meta=None):
+    """
+    Writes columns to the sidecar cache of a file, replacing any old cache.
+    Failing to write the cache (e.g. a read-only directory) is reported but not fatal.
+    :param columns: Dict of 1-d NumPy arrays
+    :param meta: JSON-serializable dict stored alongside the columns
+    """
+    tmpdir = None
+    try:
+        tmpdir = new_cache(filename, kind)
+        for name, col in columns.items():
+            np.save(os.path.join(tmpdir, "{}.npy".format(name)), np.asarray(col))
+        commit_cache(filename, kind, tmpdir, columns, meta)
+    except OSError as err:
+        cachedir = os.path.join(cache_path(filename), kind)
+        sys.stderr.write("Unable to write cache [{}]: {}\n".format(cachedir, err))
+        if tmpdir is not None:
+            shutil.rmtree(tmpdir, ignore_errors=True)
@@ -10,107 +10,728 @@ __version__ = "0.1.0"
 __license__ = "MIT"
 
 import argparse
+import collections
+import hashlib
+import io
+import multiprocessing
+import os
 import time
 import sys
+import numpy as np
 import pandas as pd
+import lastio
+
+# Columns written by 'write_last', in order
+COLUMNS = [
+    "score",
+    "idpct",
+    "covpct",
+    "name1",
+    "start1",
+    "alnSize1",
+    "end1",
+    "strand1",
+    "seqSize1",
+    "name2",
+    "start2",
+    "alnSize2",
+    "end2",
+    "strand2",
+    "seqSize2",
+    "blocks",
+    "start2+",
+    "end2+",
+]
+# Columns of last-output, with the two E-value fields
+LAST_COLUMNS = [
+    "score",
+    "name1",
+    "start1",
+    "alnSize1",
+    "strand1",
+    "seqSize1",
+    "name2",
+    "start2",
+    "alnSize2",
+    "strand2",
+    "seqSize2",
+    "blocks",
+    "EG",
+    "E",
+]
+# E-value columns, kept as the original fields such as 'E=1.2e-30', see 'evalues'
+EVALUES = ("EG", "E")
+# Types of the columns in the tables passed between the scripts, see 'read_typed'
+SCHEMA = {
+    "score": np.int64,
+    "idpct": np.float64,
+    "covpct": np.float64,
+    "name1": "category",
+    "start1": np.int64,
+    "alnSize1": np.int32,
+    "end1": np.int64,
+    "strand1": "category",
+    "seqSize1": np.int64,
+    "name2": "category",
+    "start2": np.int64,
+    "alnSize2": np.int32,
+    "end2": np.int64,
+    "strand2": "category",
+    "seqSize2": np.int64,
+    "blocks": str,
+    "start2+": np.int64,
+    "end2+": np.int64,
+    "EG": "category",
+    "E": "category",
+    "qual": np.int8,
+}
+# Integer columns taken directly from the last-file, with their field index
+INT_FIELDS = {
+    "score": 0,
+    "start1": 2,
+    "alnSize1": 3,
+    "seqSize1": 5,
+    "start2": 7,
+    "alnSize2": 8,
+    "seqSize2": 10,
+}
+# Number of alignments parsed and formatted at a time
+CHUNKSIZE = 100000
+# Largest byte range handed to one worker when parsing in parallel
+RANGESIZE = 64 * 1024 * 1024
+
+
+def parse_blocks(blocks, offsets):
+    """
+    Splits concatenated blocks-strings into their numbers, see 'calc_seqid'.
+    :return: (rows, values, gap_a, gap_b) with the alignment of each number, its value,
+        and whether it is the first or the second part of an 'a:b' gap
+    """
+    # Pad with a separator so that every number is followed by a character
+    buf = np.append(np.frombuffer(blocks, dtype=np.uint8), np.uint8(ord(",")))
+    digit = (buf >= ord("0")) & (buf <= ord("9"))
+    first = digit.copy()
+    first[1:] &= ~digit[:-1]
+    first[offsets[:-1][np.diff(offsets) > 0]] = True
+    first &= digit
+    # Numbers are read with one digit per position, weighted by its place value
+    starts = np.flatnonzero(first)
+    pos = np.flatnonzero(digit)
+    token = np.cumsum(first)[pos] - 1
+    ends = starts + np.bincount(token, minlength=len(starts))
+    place = np.power(10, ends[token] - pos - 1, dtype=np.int64)
+    values = np.zeros(len(starts), dtype=np.int64)
+    if len(starts) > 0:
+        digits = (buf[pos] - ord("0")).astype(np.int64) * place
+        values = np.add.reduceat(digits, np.searchsorted(pos, starts))
+    rows = np.searchsorted(offsets, starts, side="right") - 1
+    # A gap is written as 'a:b', anything else is an aligned block
+    gap_a = buf[ends] == ord(":")
+    gap_b = np.zeros(len(starts), dtype=bool)
+    gap_b[starts > 0] = buf[starts[starts > 0] - 1] == ord(":")
+    return rows, values, gap_a, gap_b
+
+
+def _prefix_blocks(prefix):
+    """
+    Splits the prefixes [0, prefix[i]) of a sequence into aligned blocks of 2^level
+    positions, at most one per level.
+    :return: Yields (level, queries, block) with the queries using a block at that level
+    """
+    for level in range(int(prefix.max(initial=0)).bit_length()):
+        use = np.flatnonzero((prefix >> level) & 1)
+        yield level, use, (prefix[use] >> level) - 1
+
+
+def prefix_count(prefix, values, queries, strict=True):
+    """
+    Counts, for each query i, the values among values[:prefix[i]] below queries[i],
+    or at most queries[i] when not 'strict'.
+    Each level of blocks is sorted once, so this takes O(n log^2 n) for n values.
+    """
+    ranks = np.unique(values)
+    y = np.searchsorted(ranks, values)
+    q = np.searchsorted(ranks, queries, side="left" if strict else "right")
+    pos = np.arange(len(values), dtype=np.int64)
+    out = np.zeros(len(prefix), dtype=np.int64)
+    for level, use, block in _prefix_blocks(prefix):
+        keys = np.sort((pos >> level) * len(ranks) + y)
+        base = block * len(ranks)
+        hi = np.searchsorted(keys, base + q[use], side="left")
+        out[use] += hi - np.searchsorted(keys, base, side="left")
+    return out
+
+
+def prefix_max(prefix, keys, values, queries):
+    """
+    Finds, for each query i, the largest of values[:prefix[i]] with a key of at most
+    queries[i], see 'prefix_count'.
+    :return: int64 array, with the smallest int64 where there is no such value
+    """
+    xranks, vranks = np.unique(keys), np.unique(values)
+    x = np.searchsorted(xranks, keys)
+    v = np.searchsorted(vranks, values)
+    q = np.searchsorted(xranks, queries, side="right")
+    pos = np.arange(len(keys), dtype=np.int64)
+    best = np.full(len(prefix), -1, dtype=np.int64)
+    for level, use, block in _prefix_blocks(prefix):
+        ind = np.lexsort((x, pos >> level))
+        sorted_keys = (pos[ind] >> level) * len(xranks) + x[ind]
+        # Running maximum that starts over in each block, as blocks only rise
+        reach = np.maximum.accumulate((pos[ind] >> level) * len(vranks) + v[ind])
+        at = np.searchsorted(sorted_keys, block * len(xranks) + q[use], side="left") - 1
+        found = (at >= 0) & (sorted_keys[np.maximum(at, 0)] >= block * len(xranks))
+        top = reach[at[found]] - block[found] * len(vranks)
+        best[use[found]] = np.maximum(best[use[found]], top)
+    out = np.full(len(prefix), np.iinfo(np.int64).min, dtype=np.int64)
+    out[best >= 0] = vranks[best[best >= 0]]
+    return out
+
+
+def calc_seqid(score, blocks, offsets):
+    """
+    Calculates the identity of a batch of alignments, as fractions.
+    'blocks' is a byte buffer with the blocks-strings of all alignments concatenated,
+    and 'offsets' holds the start of each string followed by the end of the last one.
+    Gaps of length g are scored as 21 + 9 * g.
+    :param score: Array of alignment scores
+    :param blocks: uint8 array (or bytes) of concatenated blocks-strings
+    :param offsets: int array of length len(score) + 1
+    :return: float64 array of identities
+    """
+    n = len(offsets) - 1
+    rows, values, gap_a, gap_b = parse_blocks(blocks, offsets)
+    block = ~(gap_a | gap_b)
+    alnSize = np.zeros(n, dtype=np.int64)
+    np.add.at(alnSize, rows[block], values[block])
+    gaps = np.zeros(n, dtype=np.int64)
+    np.add.at(gaps, rows[gap_a], np.maximum(values[gap_a], values[gap_b]))
+    gapSize = 21 * np.bincount(rows[gap_a], minlength=n) + 9 * gaps
+    mismatch = ((alnSize * 6 - gapSize) - score) / 24
+    return 1 - (mismatch + gaps) / (gaps + alnSize)
+
+
+class Names(object):
+    """ Interns sequence names as integer IDs """
+
+    def __init__(self, names=None):
+        self.names = [] if names is None else list(names)
+        self.ids = {name: ind for ind, name in enumerate(self.names)}
+
+    def __len__(self):
+        return len(self.names)
+
+    def encode(self, names):
+        ids = self.ids
+        out = np.empty(len(names), dtype=np.int32)
+        for ind, name in enumerate(names):
+            try:
+                out[ind] = ids[name]
+            except KeyError:
+                out[ind] = ids[name] = len(self.names)
+                self.names.append(name)
+        return out
+
+    def decode(self, ids):
+        names = self.names
+        return [names[i] for i in ids.tolist()]
+
+
+class Records(object):
+    """
+    Column store for parsed alignments.
+    Numeric columns are NumPy arrays, 'name1'/'name2' are IDs into a shared Names object
+    and 'blocks' are offsets into one shared byte buffer.
+    """
+
+    def __init__(self, names, columns=None, blocks=None, offsets=None):
+        self.names = names
+        if columns is None:
+            columns = {key: np.empty(0, dtype=np.int64) for key in INT_FIELDS}
+            columns["idpct"] = np.empty(0, dtype=np.float64)
+            columns["covpct"] = np.empty(0, dtype=np.float64)
+            columns["name1"] = np.empty(0, dtype=np.int32)
+            columns["name2"] = np.empty(0, dtype=np.int32)
+            columns["strand1"] = np.empty(0, dtype="S1")
+            columns["strand2"] = np.empty(0, dtype="S1")
+            columns["nfields"] = np.empty(0, dtype=np.int8)
+        self.columns = columns
+        self.blocks = np.empty(0, dtype=np.uint8) if blocks is None else blocks
+        self.offsets = np.zeros(1, dtype=np.int64) if offsets is None else offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    @classmethod
+    def from_fields(cls, names, fields):
+        """
+        Builds records from split lines with at least 12 fields.
+        The number of fields on each line is kept in the 'nfields' column.
+        """
+        n = len(fields)
+        cols = list(zip(*[l[:12] for l in fields])) if n > 0 else [()] * 12
+        columns = {
+            key: np.fromiter(map(int, cols[ind]), dtype=np.int64, count=n)
+            for key, ind in INT_FIELDS.items()
+        }
+        columns["name1"] = names.encode(cols[1])
+        columns["name2"] = names.encode(cols[6])
+        columns["strand1"] = np.array(cols[4], dtype="S1")
+        columns["strand2"] = np.array(cols[9], dtype="S1")
+        blocks = "".join(cols[11]).encode("ascii")
+        offsets = np.zeros(n + 1, dtype=np.int64)
+        lengths = np.fromiter(map(len, cols[11]), dtype=np.int64, count=n)
+        np.cumsum(lengths, out=offsets[1:])
+        columns["nfields"] = np.fromiter(map(len, fields), dtype=np.int8, count=n)
+        columns["idpct"] = 100 * calc_seqid(columns["score"], blocks, offsets)
+        columns["covpct"] = np.where(
+            columns["seqSize2"] <= columns["seqSize1"],
+            100 * (columns["alnSize2"] / columns["seqSize2"]),
+            100 * (columns["alnSize1"] / columns["seqSize1"]),
+        )
+        return cls(names, columns, np.frombuffer(blocks, dtype=np.uint8), offsets)
+
+    @classmethod
+    def from_columns(cls, names, columns):
+        """ Rebuilds records from the arrays given by 'to_columns' """
+        columns = dict(columns)
+        blocks, offsets = columns.pop("blocks"), columns.pop("offsets")
+        return cls(names, columns, blocks, offsets)
+
+    def to_columns(self):
+        """ Returns every stored array, including the blocks buffer and its offsets """
+        columns = dict(self.columns)
+        columns["blocks"] = self.blocks
+        columns["offsets"] = self.offsets
+        return columns
+
+    @classmethod
+    def concat(cls, names, parts):
+        parts = [part for part in parts if len(part) > 0]
+        if len(parts) == 0:
+            return cls(names)
+        if len(parts) == 1:
+            return parts[0]
+        columns = {
+            key: np.concatenate([part.columns[key] for part in parts])
+            for key in parts[0].columns
+        }
+        blocks = np.concatenate([part.blocks for part in parts])
+        shift = np.cumsum([0] + [len(part.blocks) for part in parts[:-1]])
+        offsets = np.concatenate(
+            [[0]] + [part.offsets[1:] + s for part, s in zip(parts, shift)]
+        ).astype(np.int64)
+        return cls(names, columns, blocks, offsets)
+
+    def slice(self, lo, hi):
+        """ Returns rows lo to hi, sharing memory with these records where possible """
+        columns = {key: col[lo:hi] for key, col in self.columns.items()}
+        blocks = self.blocks[self.offsets[lo] : self.offsets[hi]]
+        offsets = self.offsets[lo : hi + 1] - self.offsets[lo]
+        return Records(self.names, columns, blocks, offsets)
+
+    def take(self, mask):
+        """ Returns the records selected by a boolean mask """
+        lengths = np.diff(self.offsets)
+        columns = {key: col[mask] for key, col in self.columns.items()}
+        blocks = self.blocks[np.repeat(mask, lengths)]
+        offsets = np.zeros(np.count_nonzero(mask) + 1, dtype=np.int64)
+        np.cumsum(lengths[mask], out=offsets[1:])
+        return Records(self.names, columns, blocks, offsets)
+
+    def passes(self, idlim=0, covlim=0, lenlim=0):
+        """ Returns a boolean mask of the records passing the limits """
+        cols = self.columns
+        return (
+            (cols["idpct"] >= idlim)
+            & (cols["alnSize2"] >= lenlim)
+            & (cols["covpct"] >= covlim)
+        )
+
+    def rename(self, names):
+        """ Returns the records with name IDs translated to another Names object """
+        if names is self.names:
+            return self
+        ids = names.encode(self.names.names)
+        columns = dict(self.columns)
+        columns["name1"] = ids[columns["name1"]]
+        columns["name2"] = ids[columns["name2"]]
+        return Records(names, columns, self.blocks, self.offsets)
+
+    def column(self, key):
+        """ Returns a column from 'COLUMNS' as an array, deriving it when needed """
+        cols = self.columns
+        if key in cols and key not in ("name1", "name2"):
+            return cols[key]
+        if key in ("name1", "name2"):
+            return np.array(self.names.names, dtype=object)[cols[key]]
+        if key == "blocks":
+            return np.array(self.get_blocks(), dtype=object)
+        if key == "end1":
+            return cols["start1"] + cols["alnSize1"]
+        end2 = cols["start2"] + cols["alnSize2"]
+        if key == "end2":
+            return end2
+        minus = cols["strand2"] == b"-"
+        if key == "start2+":
+            return np.where(minus, cols["seqSize2"] - end2, cols["start2"])
+        if key == "end2+":
+            return np.where(minus, cols["seqSize2"] - cols["start2"], end2)
+        raise KeyError(key)
+
+    def gaps(self):
+        """
+        Lists the gaps of all alignments as intervals on the first sequence.
+        Gaps with no bases in the first sequence are empty intervals.
+        :return: (rows, starts, ends) arrays, in order of the alignments
+        """
+        rows, values, gap_a, gap_b = parse_blocks(self.blocks, self.offsets)
+        # Bases of the first sequence covered before each number of an alignment
+        step = np.where(gap_b, 0, values)
+        before = np.cumsum(step) - step
+        before -= before[np.searchsorted(rows, rows)]
+        starts = self.columns["start1"][rows[gap_a]] + before[gap_a]
+        return rows[gap_a], starts, starts + values[gap_a]
+
+    def get_blocks(self):
+        """ Returns the blocks-strings as a list """
+        text = self.blocks.tobytes().decode("ascii")
+        bounds = self.offsets.tolist()
+        return [text[s:e] for s, e in zip(bounds[:-1], bounds[1:])]
+
+    def to_dataframe(self):
+        """ Returns the records as a DataFrame, with names and strands as categories """
+        df = pd.DataFrame({key: self.column(key) for key in COLUMNS})
+        names = pd.Index(self.names.names)
+        for key in ["name1", "name2"]:
+            df[key] = pd.Categorical.from_codes(self.columns[key], categories=names)
+        for key in ["strand1", "strand2"]:
+            df[key] = pd.Categorical(self.columns[key].astype("U1"))
+        return df
+
+    def iter_lines(self):
+        """ Formats the records as tab-separated lines, one chunk at a time """
+        for lo in range(0, len(self), CHUNKSIZE):
+            part = self.slice(lo, min(lo + CHUNKSIZE, len(self)))
+            cols = []
+            for key in COLUMNS:
+                if key in ("name1", "name2"):
+                    cols.append(self.names.decode(part.columns[key]))
+                elif key == "blocks":
+                    cols.append(part.get_blocks())
+                elif key in ("strand1", "strand2"):
+                    cols.append(part.columns[key].astype("U1").tolist())
+                else:
+                    cols.append(map(str, part.column(key).tolist()))
+            cols[-1] = ["{}\n".format(value) for value in cols[-1]]
+            yield from map("\t".join, zip(*cols))
+
+
+class BedIndex(object):
+    """
+    Regions from a BED file, sorted by sequence and start, for overlap queries on many
+    intervals at once.
+    Sequences are the IDs of a Names object, and positions are combined with them into
+    one sorted key space, so each query is a binary search over all regions.
+    """
+
+    def __init__(self, seqs, starts, stops, labels=None):
+        seqs = np.asarray(seqs, dtype=np.int64)
+        starts = np.asarray(starts, dtype=np.int64)
+        stops = np.asarray(stops, dtype=np.int64)
+        # Regions in key order, as row numbers of the BED file
+        self.order = np.lexsort((starts, seqs))
+        self.seqs = seqs[self.order]
+        self.starts = starts[self.order]
+        self.stops = stops[self.order]
+        self.labels = labels
+        if len(seqs) > 0:
+            # Query positions are clipped into [lo, lo + stride), which keeps every
+            # strict comparison with a region position
+            self.lo = min(starts.min(), stops.min()) - 1
+            self.stride = max(starts.max(), stops.max()) + 2 - self.lo
+            self.start_keys = self._key(self.seqs, self.starts)
+            # Furthest stop of the regions up to each one, only rising across sequences
+            self.reach = np.maximum.accumulate(self._key(self.seqs, self.stops))
+
+    def __len__(self):
+        return len(self.order)
+
+    @classmethod
+    def read_bed(cls, bedfile, names, labels=False, cache=False):
+        """
+        Reads the regions of a BED file that are on sequences known to 'names'.
+        :param names: Names object, which is not extended
+        :param labels: Keep the fourth column, the region names, as 'self.labels'
+        :param cache: Use the sidecar cache, see 'read_frame'
+        """
+        usecols = [0, 1, 2, 3] if labels else [0, 1, 2]
+        try:
+            df = read_frame(
+                bedfile,
+                cache=cache,
+                comment="#",
+                header=None,
+                usecols=usecols,
+                dtype={col: str for col in usecols if col in (0, 3)},
+                sep=r"\s+",
+            )
+        except pd.errors.EmptyDataError:
+            df = pd.DataFrame({col: [] for col in usecols})
+        seqs = df[0].astype(str).map(names.ids)
+        keep = seqs.notna().to_numpy()
+        seqs = seqs.to_numpy()[keep].astype(np.int64)
+        starts = df[1].to_numpy()[keep].astype(np.int64)
+        stops = df[2].to_numpy()[keep].astype(np.int64)
+        if labels:
+            labels = df[3].astype(str).to_numpy()[keep]
+        else:
+            labels = None
+        return cls(seqs, starts, stops, labels)
+
+    def _key(self, seqs, pos):
+        pos = np.clip(pos, self.lo, self.lo + self.stride - 1) - self.lo
+        return np.asarray(seqs, dtype=np.int64) * self.stride + pos
+
+    def overlaps(self, seqs, starts, ends):
+        """
+        Tells which of the intervals overlap at least one region, i.e. have a region
+        with 'start < end' and 'stop > start' on the same sequence.
+        :return: Boolean array
+        """
+        if len(self) == 0:
+            return np.zeros(len(seqs), dtype=bool)
+        # Regions starting before each interval ends
+        k = np.searchsorted(self.start_keys, self._key(seqs, ends), side="left")
+        reach = self.reach[np.maximum(k - 1, 0)]
+        return (k > 0) & (reach > self._key(seqs, starts))
+
+    def first_overlap(self, seqs, starts, ends):
+        """
+        Finds the first region, in the order of the BED file, overlapping each interval.
+        The candidates of an interval lie between the first region reaching past its
+        start and the last region starting before its end, so long regions that span
+        many others make this slower.
+        :return: Row number in the BED file, or -1 where no region overlaps
+        """
+        out = np.full(len(seqs), -1, dtype=np.int64)
+        if len(self) == 0:
+            return out
+        lo_key, hi_key = self._key(seqs, starts), self._key(seqs, ends)
+        lo = np.searchsorted(self.reach, lo_key, side="right")
+        hi = np.searchsorted(self.start_keys, hi_key, side="left")
+        size = np.maximum(hi - lo, 0)
+        # Every (interval, candidate) pair, as flat arrays
+        query = np.repeat(np.arange(len(seqs)), size)
+        cand = np.arange(size.sum()) - np.repeat(np.cumsum(size) - size, size)
+        cand += np.repeat(lo, size)
+        hit = self._key(self.seqs[cand], self.stops[cand]) > lo_key[query]
+        first = np.full(len(seqs), len(self), dtype=np.int64)
+        np.minimum.at(first, query[hit], self.order[cand[hit]])
+        out[first < len(self)] = first[first < len(self)]
+        return out
+
+
+class PartnerIndex(object):
+    """
+    Distinct partners of every sequence, i.e. the sequences it is aligned to.
+    The partners of the sequence with ID i are 'partners[offsets[i] : offsets[i + 1]]',
+    sorted by ID, and 'degree[i]' is their number.
+    'crowded[i]' tells whether one of the partners of i has more than one partner.
+    Example:
+        index = PartnerIndex.from_table(Last("in.last").read_table())
+        index.count("ctg1"), index.get("ctg1")
+    """
+
+    def __init__(self, names, name1, name2):
+        self.names = names
+        n = len(names)
+        src = np.concatenate([name1, name2]).astype(np.int64)
+        dst = np.concatenate([name2, name1]).astype(np.int64)
+        pairs = np.unique(src * n + dst)
+        nodes = pairs // n
+        self.partners = pairs % n
+        self.offsets = np.zeros(n + 1, dtype=np.int64)
+        np.cumsum(np.bincount(nodes, minlength=n), out=self.offsets[1:])
+        self.degree = np.diff(self.offsets)
+        self.crowded = np.zeros(n, dtype=bool)
+        self.crowded[nodes[self.degree[self.partners] > 1]] = True
+
+    @classmethod
+    def from_table(cls, records):
+        return cls(records.names, records.columns["name1"], records.columns["name2"])
+
+    def _id(self, name):
+        return self.names.ids.get(name) if isinstance(name, str) else name
+
+    def count(self, name):
+        """ Number of distinct partners of a sequence, given by name or ID """
+        ind = self._id(name)
+        return 0 if ind is None else int(self.degree[ind])
+
+    def get(self, name):
+        """ Names of the distinct partners of a sequence, given by name or ID """
+        ind = self._id(name)
+        if ind is None:
+            return []
+        return self.names.decode(
+            self.partners[self.offsets[ind] : self.offsets[ind + 1]]
+        )
 
 
 class Last(object):
 
     def __init__(self, lastfile):
         self.lastfile = lastfile
-        self.lines = []
         self.header = []
+        self.names = Names()
+        self.records = Records(self.names)
 
-    def _calc_seqid(self, score, blocks):
-        alnSize = 0
-        gaps = 0
-        gapSize = 0
-        for b in blocks.split(","):
-            if ":" in b:
-                gap = max([int(a) for a in b.split(":")])
-                gaps += gap
-                gapSize += 21 + 9 * gap
-            else:
-                alnSize += int(b)
-        mismatch = ((alnSize * 6 - gapSize) - score) / 24
-        return 1 - (mismatch + gaps) / (gaps + alnSize)
+    def _parse_lines(self, lines, idlim=0, covlim=0, lenlim=0):
+        """
+        Parses a chunk of alignment lines and keeps the ones passing the limits.
+        Lines without exactly 14 fields are skipped.
+        """
+        fields = [l for l in (line.split() for line in lines) if len(l) == 14]
+        records = Records.from_fields(self.names, fields)
+        # Deciding to keep the alignment
+        return records.take(records.passes(idlim, covlim, lenlim))
 
-    def read_last(self, idlim=0, covlim=0, lenlim=0):
+    def iter_records(self, idlim=0, covlim=0, lenlim=0, chunksize=CHUNKSIZE):
         """
-        Reads each alignment from the last-alignment file.
-        :param makedb:
+        Reads the last-alignment file and yields the alignments passing the limits,
+        as Records of at most 'chunksize' input lines at a time.
+        The header is collected into 'self.header' before the first Records are yielded.
         :param idlim: Minimum percent identity, in percent
         :param covlim: Minimum coverage, in percent
         :param lenlim: Minimum alignment length
+        :param chunksize: Number of lines parsed per batch
         :return:
         """
+        with lastio.open_file(self.lastfile, "r") as fin:
+            yield from self._iter_records(fin, idlim, covlim, lenlim, chunksize)
+
+    def _iter_records(self, fin, idlim, covlim, lenlim, chunksize):
+        for lines in self._iter_chunks(fin, chunksize):
+            yield self._parse_lines(lines, idlim, covlim, lenlim)
+
+    def _iter_chunks(self, fin, chunksize):
+        """ Yields lists of alignment lines, collecting the leading comments as header """
+        head = True
+        lines = []
+        for line in fin:
+            if line.startswith("#"):
+                if head:
+                    self.header.append(line)
+                continue
+            head = False
+            lines.append(line)
+            if len(lines) == chunksize:
+                yield lines
+                lines = []
+        if len(lines) > 0:
+            yield lines
+
+    def _iter_raw_chunks(self, fin, chunksize):
+        """
+        Yields lists of alignment lines from a file opened in binary mode,
+        together with the byte offset and length of each line.
+        """
         head = True
-        with open(self.lastfile, "r") as fin:
-            for line in fin:
-                if line.startswith("#"):
-                    if head:
-                        self.header.append(line)
-                    continue
+        pos = 0
+        lines = []
+        starts = []
+        for line in fin:
+            if line.startswith(b"#"):
+                if head:
+                    self.header.append(line.decode())
+            else:
                 head = False
-                l = line.strip().split()
-                if len(l) != 14:
-                    continue
-                score, start1, alnSize1, seqSize1, start2, alnSize2, seqSize2 = [
-                    int(i) for i in [l[0], l[2], l[3], l[5], l[7], l[8], l[10]]
-                ]
-                name1, strand1, name2, strand2, blocks, *e = [
-                    l[1],
-                    l[4],
-                    l[6],
-                    l[9],
-                    l[11],
-                    l[12:],
-                ]
-                end1 = start1 + alnSize1
-                end2 = start2 + alnSize2
-                if strand2 == "-":
-                    start2p = seqSize2 - end2
-                    end2p = seqSize2 - start2
-                else:
-                    start2p = start2
-                    end2p = end2
-                seqid = 100 * self._calc_seqid(score, blocks)
-                if seqSize2 <= seqSize1:
-                    seqcov = 100 * (alnSize2 / seqSize2)
-                else:
-                    seqcov = 100 * (alnSize1 / seqSize1)
-                # Deciding to keep the alignment
-                if seqid < idlim:
-                    continue
-                if alnSize2 < lenlim:
-                    continue
-                if seqcov < covlim:
-                    continue
-                self.lines.append(
-                    [
-                        score,
-                        seqid,
-                        seqcov,
-                        name1,
-                        start1,
-                        alnSize1,
-                        end1,
-                        strand1,
-                        seqSize1,
-                        name2,
-                        start2,
-                        alnSize2,
-                        end2,
-                        strand2,
-                        seqSize2,
-                        blocks,
-                        start2p,
-                        end2p,
-                    ]
-                )
+                lines.append(line)
+                starts.append(pos)
+                if len(lines) == chunksize:
+                    yield lines, starts
+                    lines, starts = [], []
+            pos += len(line)
+        if len(lines) > 0:
+            yield lines, starts
 
-    def write_last(self, fout=sys.stdout):
+    def iter_table(self, names=None, chunksize=CHUNKSIZE):
+        """
+        Yields the alignment lines with at least 12 fields as Records, one chunk at a
+        time, with the 'offset' and 'length' columns of 'read_table'.
+        :param names: Names object shared by the chunks, defaults to 'self.names'
+        """
+        names = self.names if names is None else names
+        with lastio.open_file(self.lastfile, "rb") as fin:
+            for lines, starts in self._iter_raw_chunks(fin, chunksize):
+                text = b"".join(lines).decode().split("\n")
+                fields = [l.split() for l in text[: len(lines)]]
+                keep = [ind for ind, l in enumerate(fields) if len(l) >= 12]
+                part = Records.from_fields(names, [fields[ind] for ind in keep])
+                part.columns["offset"] = np.array(starts, dtype=np.int64)[keep]
+                lengths = np.array([len(line) for line in lines], dtype=np.int64)
+                part.columns["length"] = lengths[keep]
+                yield part
+
+    def read_table(self, cache=False):
+        """
+        Reads every alignment line with at least 12 fields, without any filtering.
+        The 'offset' and 'length' columns give the position of each line in the file.
+        With 'cache', the parsed columns are stored in a sidecar directory next to the
+        last-file the first time, and memory-mapped from there on later calls.
+        :return: Records, sharing 'self.names'
+        """
+        cached = lastio.load_cache(self.lastfile, "last") if cache else None
+        if cached is not None:
+            meta, columns = cached
+            self.header.extend(meta["header"])
+            records = Records.from_columns(Names(meta["names"]), columns)
+        else:
+            head = len(self.header)
+            names = Names()
+            records = Records.concat(names, list(self.iter_table(names)))
+            for key in ("offset", "length"):
+                records.columns.setdefault(key, np.zeros(0, dtype=np.int64))
+            if cache:
+                meta = {"names": names.names, "header": self.header[head:]}
+                lastio.save_cache(self.lastfile, "last", records.to_columns(), meta)
+        if len(self.names) == 0:
+            self.names = self.records.names = records.names
+        return records.rename(self.names)
+
+    def read_header(self):
+        """ Reads the comment lines at the start of the last-alignment file """
+        with lastio.open_file(self.lastfile, "r") as fin:
+            for line in fin:
+                if not line.startswith("#"):
+                    break
+                self.header.append(line)
+
+    def read_last(self, idlim=0, covlim=0, lenlim=0, cache=False):
+        """
+        Reads each alignment from the last-alignment file.
+        Alignments are parsed in chunks and stored column by column in 'self.records'.
+        :param idlim: Minimum percent identity, in percent
+        :param covlim: Minimum coverage, in percent
+        :param lenlim: Minimum alignment length
+        :param cache: Use the sidecar cache, see 'read_table'
+        :return:
+        """
+        parts = [self.records]
+        if cache:
+            table = self.read_table(cache=True)
+            keep = table.passes(idlim, covlim, lenlim)
+            keep &= table.columns["nfields"] == 14
+            parts.append(table.take(keep))
+        else:
+            parts.extend(self.iter_records(idlim, covlim, lenlim))
+        self.records = Records.concat(self.names, parts)
+
+    def to_dataframe(self):
+        return self.records.to_dataframe()
+
+    def write_header(self, fout=sys.stdout):
         for line in self.header:
             l = line.strip().split()
             if len(l) > 1 and l[1] == "score":
@@ -124,9 +745,238 @@ class Last(object):
                 continue
             line = "{}\n".format("\t".join(l[1:]))
             fout.write(line)
-        for line in self.lines:
-            output = "\t".join([str(b) for b in line])
-            fout.write("{}\n".format(output))
+
+    def write_last(self, fout=sys.stdout):
+        self.write_header(fout)
+        fout.writelines(self.records.iter_lines())
+
+    def write_stream(
+        self, fout=sys.stdout, idlim=0, covlim=0, lenlim=0, chunksize=10000
+    ):
+        """
+        Parses, filters and writes the alignments one batch at a time.
+        Nothing is kept in 'self.records', so memory use does not depend on the file size.
+        """
+        head = True
+        for records in self.iter_records(idlim, covlim, lenlim, chunksize):
+            if head:
+                self.write_header(fout)
+                head = False
+            fout.writelines(records.iter_lines())
+            fout.flush()
+        if head:
+            self.write_header(fout)
+
+    def write_parallel(self, fout=sys.stdout, idlim=0, covlim=0, lenlim=0, jobs=1):
+        """
+        Parses, filters and writes the alignments using 'jobs' worker processes.
+        The file is split into byte ranges on line boundaries, and the ranges are
+        written back in their original order, giving the same output as 'write_last'.
+        Compressed files are decompressed here and handed to the workers in pieces.
+        """
+        self.read_header()
+        self.write_header(fout)
+        limits = (idlim, covlim, lenlim)
+        if lastio.is_compressed(self.lastfile):
+            worker = _parse_range
+            fin = lastio.open_file(self.lastfile, "rb")
+            tasks = ((data,) + limits for data in _iter_pieces(fin, RANGESIZE // 4))
+        else:
+            worker = _read_range
+            parts = max(jobs * 4, os.path.getsize(self.lastfile) // RANGESIZE)
+            tasks = (
+                (self.lastfile, start, end) + limits
+                for start, end in split_file(self.lastfile, parts)
+            )
+        # Only a few ranges are in flight at a time, to keep memory bounded
+        with multiprocessing.Pool(jobs) as pool:
+            pending = collections.deque()
+            for task in tasks:
+                pending.append(pool.apply_async(worker, (task,)))
+                if len(pending) > 2 * jobs:
+                    fout.write(pending.popleft().get())
+            while len(pending) > 0:
+                fout.write(pending.popleft().get())
+
+
+def read_frame(filename, cache=False, **kwargs):
+    """
+    Reads a table with 'pandas.read_csv', optionally through the sidecar cache.
+    Text columns are returned as categoricals when read from the cache.
+    :param kwargs: Passed on to 'pandas.read_csv', and part of the cache key
+    :return: DataFrame
+    """
+    spec = repr(sorted(kwargs.items()))
+    df = _load_frame(filename, "frame", spec) if cache else None
+    if df is not None:
+        return df
+    with lastio.open_file(filename, "r") as fin:
+        df = pd.read_csv(fin, **kwargs)
+    if cache:
+        _save_frame(filename, "frame", spec, df)
+    return df
+
+
+def _frame_kind(prefix, spec):
+    return "{}-{}".format(prefix, hashlib.md5(spec.encode()).hexdigest()[:12])
+
+
+def _load_frame(filename, prefix, spec):
+    """ Returns a DataFrame stored by '_save_frame' with the same spec, or None """
+    cached = lastio.load_cache(filename, _frame_kind(prefix, spec))
+    if cached is None or cached[0]["spec"] != spec:
+        return None
+    meta, columns = cached
+    df = pd.DataFrame(index=pd.RangeIndex(meta["rows"]))
+    for ind, key in enumerate(meta["order"]):
+        col = "c{}".format(ind)
+        if col in meta["categories"]:
+            categories = meta["categories"][col]
+            df[key] = pd.Categorical.from_codes(columns[col], categories=categories)
+        else:
+            df[key] = columns[col]
+    return df
+
+
+def _save_frame(filename, prefix, spec, df):
+    columns = {}
+    categories = {}
+    for ind, key in enumerate(df.columns):
+        col = df[key]
+        if col.dtype.kind in "biuf":
+            columns["c{}".format(ind)] = col.to_numpy()
+        else:
+            col = col.astype("category")
+            columns["c{}".format(ind)] = col.cat.codes.to_numpy()
+            categories["c{}".format(ind)] = col.cat.categories.tolist()
+    meta = {
+        "rows": len(df),
+        "order": list(df.columns),
+        "categories": categories,
+        "spec": spec,
+    }
+    lastio.save_cache(filename, _frame_kind(prefix, spec), columns, meta)
+
+
+def _evalue(text):
+    """ Parses an E-value field such as 'E=1.2e-30' """
+    return float(text.split("=", 1)[-1])
+
+
+def evalues(column):
+    """ Values of an E-value column read by 'read_typed', as floats (NaN if missing) """
+    column = column.astype("category")
+    values = column.cat.categories.map(_evalue).to_numpy(dtype=np.float64)
+    return np.append(values, np.nan)[column.cat.codes.to_numpy()]
+
+
+def read_typed(
+    filename,
+    header=True,
+    max_evalue=None,
+    usecols=None,
+    skip_bad=False,
+    cache=False,
+    chunksize=CHUNKSIZE,
+):
+    """
+    Reads a table of alignments in chunks, with the column types of SCHEMA.
+    :param header: The first line names the columns, otherwise the file is last-output
+        with the columns in LAST_COLUMNS
+    :param max_evalue: Only keep lines with an E-value of at most this, filtered chunk
+        by chunk so only the kept lines are held in memory
+    :param usecols: Only read these columns
+    :param skip_bad: Skip lines with too many fields instead of failing
+    :param cache: Use the sidecar cache, see 'read_frame'
+    :return: DataFrame
+    """
+    spec = repr((header, max_evalue, usecols, skip_bad, SCHEMA))
+    df = _load_frame(filename, "typed", spec) if cache else None
+    if df is not None:
+        for key in df.columns:
+            if SCHEMA.get(key) is str:
+                df[key] = df[key].astype(object)
+        return df
+    kwargs = {
+        "sep": r"\s+",
+        "comment": "#",
+        "header": 0 if header else None,
+        "names": None if header else LAST_COLUMNS,
+        "usecols": usecols,
+        "dtype": SCHEMA,
+        "on_bad_lines": "skip" if skip_bad else "error",
+        "chunksize": chunksize,
+    }
+    parts = []
+    with lastio.open_file(filename, "r") as fin:
+        for chunk in pd.read_csv(fin, **kwargs):
+            if max_evalue is not None:
+                chunk = chunk[evalues(chunk["E"]) <= max_evalue]
+            parts.append(chunk)
+    if len(parts) == 0:
+        raise pd.errors.EmptyDataError("No columns to parse from file")
+    df = pd.concat(parts, ignore_index=True)
+    for key in df.columns:
+        if SCHEMA.get(key) == "category":
+            categories = pd.api.types.union_categoricals([part[key] for part in parts])
+            df[key] = pd.Categorical(
+                df[key], categories=categories.categories
+            ).remove_unused_categories()
+    if cache:
+        _save_frame(filename, "typed", spec, df)
+    return df
+
+
+def write_typed(df, filename):
+    """ Writes a table read by 'read_typed', with the E-value fields as they were read """
+    with lastio.open_file(filename, "w") as fout:
+        df.to_csv(fout, sep="\t", index=None)
+
+
+def split_file(filename, parts):
+    """
+    Splits a file into at most 'parts' byte ranges that start and end on line boundaries.
+    :return: List of (start, end) byte offsets
+    """
+    size = os.path.getsize(filename)
+    bounds = [0]
+    with open(filename, "rb") as fin:
+        for ind in range(1, parts):
+            fin.seek(max(size * ind // parts, bounds[-1]))
+            fin.readline()
+            bounds.append(min(fin.tell(), size))
+    bounds.append(size)
+    return [(s, e) for s, e in zip(bounds[:-1], bounds[1:]) if e > s]
+
+
+def _iter_pieces(fin, size):
+    """ Yields pieces of about 'size' bytes from a binary stream, ending on line breaks """
+    with fin:
+        while True:
+            data = fin.read(size)
+            if len(data) == 0:
+                break
+            yield data + fin.readline()
+
+
+def _read_range(task):
+    """ Worker for 'Last.write_parallel', returns the formatted alignments of one range """
+    lastfile, start, end, idlim, covlim, lenlim = task
+    with open(lastfile, "rb") as fin:
+        fin.seek(start)
+        data = fin.read(end - start)
+    return _parse_range((data, idlim, covlim, lenlim))
+
+
+def _parse_range(task):
+    """ Worker for 'Last.write_parallel', formats the alignments in a piece of text """
+    data, idlim, covlim, lenlim = task
+    last = Last(None)
+    out = []
+    with io.TextIOWrapper(io.BytesIO(data)) as fin:
+        for records in last._iter_records(fin, idlim, covlim, lenlim, CHUNKSIZE):
+            out.extend(records.iter_lines())
+    return "".join(out)
 
 
 class Last2(object):
@@ -231,58 +1081,6 @@ def single_hit_qc(lastfile):
                     fout1.write(line)
 
 
-def read_graph(lastfile):
-    """ Records Last entries in a dict:
-        Key: sequence name (both name1 and name2)
-        Value: Score and name of the highest scoring match
-    """
-    db = {}
-    with open(lastfile, "r") as fin:
-        for line in fin:
-            if line.startswith("#"):
-                continue
-            score, name1, start1, alnSize1, strand1, seqSize1, name2, start2, alnSize2, strand2, seqSize2, blocks, *e = (
-                line.strip().split()
-            )
-            if name2 not in db:
-                db[name2] = {"score": int(score), "name1": name1, "links": []}
-            else:
-                if int(score) > db[name2]["score"]:
-                    db[name2] = {"score": int(score), "name1": name1, "links": []}
-            if name1 not in db:
-                db[name1] = {"score": int(score), "name2": name2, "links": []}
-            else:
-                if int(score) > db[name1]["score"]:
-                    db[name1] = {"score": int(score), "name2": name2, "links": []}
-        for name, entry in db.items():
-            if "name1" in entry:
-                name1 = entry["name1"]
-                db[name1]["links"].append(name)
-            elif "name2" in entry:
-                name2 = entry["name2"]
-                db[name2]["links"].append(name)
-    return db
-
-
-def write_graph(db, outfile):
-    """ Uses dict from 'read_graph' to output the best match from name1 to name2,
-        and name2s best match from name1
-    """
-    with open(outfile, "w") as fout:
-        for name, entry in db.items():
-            if "name1" in entry:
-                continue
-            name1, score, name2 = name, entry["score"], entry["name2"]
-            try:
-                score2, oname1 = db[name2]["score"], db[name2]["name1"]
-            except KeyError:
-                print(name, name2)
-                print(db[name2])
-            fout.write(
-                "{}\t{}\t{}\t{}\t{}\n".format(name1, score, name2, score2, oname1)
-            )
-
-
 def unique_match(lastfile):
     """ Identifies unique matches, i.e. sequences that only match to each other """
     db = {}
@@ -612,11 +1410,18 @@ def main(args):
     """ Main entry point of the app """
     last = Last(args.infile)
     idlim, covlim, lenlim = [int(a) for a in args.limits.split(",")]
-    last.read_last(idlim=idlim, covlim=covlim, lenlim=lenlim)
-    if args.outfile is not None:
-        last.write_last(open(args.outfile, "w"))
+    fout = sys.stdout if args.outfile is None else open(args.outfile, "w")
+    if args.jobs > 1:
+        last.write_parallel(
+            fout, idlim=idlim, covlim=covlim, lenlim=lenlim, jobs=args.jobs
+        )
+    elif args.stream:
+        last.write_stream(fout, idlim=idlim, covlim=covlim, lenlim=lenlim)
     else:
-        last.write_last()
+        last.read_last(idlim=idlim, covlim=covlim, lenlim=lenlim, cache=args.cache)
+        last.write_last(fout)
+    if args.outfile is not None:
+        fout.close()
     if args.log:
         with open("parselast.log", "a") as fout:
             fout.write("[{}]\t[{}]\n".format(time.asctime(), " ".join(sys.argv)))
@@ -644,6 +1449,27 @@ if __name__ == "__main__":
     parser.add_argument(
         "-c", "--limits", default="0,0,0", help="Minimum idpct, covpct and length"
     )
+    parser.add_argument(
+        "-s",
+        "--stream",
+        action="store_true",
+        default=False,
+        help="Write alignments in batches while reading, using constant memory",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=1,
+        help="Number of worker processes used for parsing, not with -s or -C",
+    )
+    parser.add_argument(
+        "-C",
+        "--cache",
+        action="store_true",
+        default=False,
+        help="Keep the parsed file in a '<infile>.cache' directory and reuse it",
+    )
     # parser.add_argument("-b", "--bedfile", help='bed-file')
     # parser.add_argument("-n", "--name", action="store", dest="name")
 
@@ -660,4 +1486,6 @@ if __name__ == "__main__":
     )
 
     args = parser.parse_args()
+    if args.jobs > 1 and (args.stream or args.cache):
+        parser.error("-j/--jobs cannot be combined with -s/--stream or -C/--cache")
     main(args)
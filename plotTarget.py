@@ -4,8 +4,12 @@
 Create a plot of LAST alignment
 Input file must contain only one target sequence.
 Hits are displayed as boxes with colour based on name of query sequence
+The hits are packed into lanes, so hits that do not overlap share a row, and all boxes
+are drawn as one collection built from arrays. Labels are only drawn where they fit,
+and above DENSITY_HITS hits the plot is a density image of the lanes instead.
 """
 
+import heapq
 import sys
 import pandas as pd
 import matplotlib.pyplot as plt
@@ -13,6 +17,17 @@ import numpy as np
 import matplotlib.colors as colors
 import matplotlib.cm as cm
 import matplotlib.patches as patches
+from matplotlib.collections import PolyCollection
+import parseLast
+
+# Resolution of the saved figure
+DPI = 90
+# Hits drawn as a density image above this number
+DENSITY_HITS = 200000
+# Hits not retained are hatched up to this number, and faded above it
+HATCH_HITS = 2000
+# Font size of the labels, in points
+LABELSIZE = 10
 
 
 def roundup(x, n):
@@ -20,52 +35,129 @@ def roundup(x, n):
     return x if x % N == 0 else x + N - x % N
 
 
+def pack_lanes(starts, ends):
+    """
+    Assigns each hit, in order of start, to the lowest lane that is free at its start
+    :return: Lane of each hit
+    """
+    lanes = np.empty(len(starts), dtype=np.int64)
+    busy = []  # (end, lane) of the hits placed so far
+    idle = []  # lanes whose last hit has ended
+    count = 0
+    order = np.argsort(starts, kind="stable")
+    hits = zip(order.tolist(), starts[order].tolist(), ends[order].tolist())
+    for i, start, end in hits:
+        while len(busy) > 0 and busy[0][0] <= start:
+            heapq.heappush(idle, heapq.heappop(busy)[1])
+        if len(idle) > 0:
+            lane = heapq.heappop(idle)
+        else:
+            lane = count
+            count += 1
+        heapq.heappush(busy, (end, lane))
+        lanes[i] = lane
+    return lanes
+
+
+def draw_hits(axes, starts, ends, lanes, facecolors, hatched, h=1):
+    """
+    Draws the hits as two collections of boxes, the second one hatched
+    Hatching is slow to render, so above HATCH_HITS the second collection is faded.
+    """
+    verts = np.empty((len(starts), 4, 2))
+    verts[:, 0, 0] = verts[:, 1, 0] = starts
+    verts[:, 2, 0] = verts[:, 3, 0] = ends
+    verts[:, 0, 1] = verts[:, 3, 1] = lanes * h
+    verts[:, 1, 1] = verts[:, 2, 1] = lanes * h + h
+    faded = hatched.sum() > HATCH_HITS
+    for mask, hatch in ((~hatched, None), (hatched, None if faded else "*")):
+        if mask.any():
+            fill = facecolors[mask]
+            if mask is hatched and faded:
+                fill = fill.copy()
+                fill[:, 3] = 0.3
+            axes.add_collection(
+                PolyCollection(
+                    verts[mask],
+                    facecolors=fill,
+                    linewidths=0,
+                    hatch=hatch,
+                    rasterized=len(starts) > 10000,
+                )
+            )
+
+
+def draw_density(axes, starts, ends, lanes, minx, maxx, nlanes, shape):
+    """
+    Draws the number of hits in each pixel as an image
+    :param shape: Pixels of the axes as (rows, columns)
+    """
+    ny, nx = min(nlanes, shape[0]), shape[1]
+    scale = nx / max(maxx - minx, 1)
+    col0 = np.clip(((starts - minx) * scale).astype(np.int64), 0, nx - 1)
+    col1 = np.clip(((ends - minx) * scale).astype(np.int64) + 1, 1, nx)
+    row = lanes * ny // nlanes
+    # Difference array along each row of the image
+    diff = np.zeros((ny, nx + 1), dtype=np.int64)
+    np.add.at(diff, (row, col0), 1)
+    np.add.at(diff, (row, col1), -1)
+    image = np.cumsum(diff[:, :nx], axis=1)
+    axes.imshow(
+        np.ma.masked_equal(image, 0),
+        origin="lower",
+        extent=(minx, maxx, 0, nlanes),
+        aspect="auto",
+        interpolation="nearest",
+        cmap=cm.viridis,
+    )
+
+
+def draw_labels(axes, starts, ends, lanes, labels, minx, maxx, shape, h=1):
+    """ Labels the hits whose box is wide and tall enough to hold the text """
+    fontpx = LABELSIZE * DPI / 72.0
+    if shape[0] / max(lanes.max() + 1, 1) < fontpx:
+        return
+    width = (ends - starts) * shape[1] / max(maxx - minx, 1)
+    fits = width >= np.array([len(label) for label in labels]) * 0.6 * fontpx
+    for i in np.flatnonzero(fits).tolist():
+        axes.text(
+            starts[i] * 1.0001,
+            lanes[i] * h + 0.1,
+            labels[i],
+            size=LABELSIZE,
+            clip_on=True,
+            bbox={"facecolor": "white", "alpha": 1, "pad": 1},
+        )
+
+
 def plot_coverage(filename):
     """
     Plots the location of hits
     """
     print("Reading {}".format(filename))
-    df = pd.read_table(
-        filename, comment="#", header=0, delim_whitespace=True, error_bad_lines=False
-    )
+    df = parseLast.read_typed(filename, skip_bad=True)
     df["end1"] = df["start1"] + df["alnSize1"]
-    df.sort_values(by=("start1"), inplace=True)
+    df.sort_values(by=("start1"), inplace=True, kind="stable")
     minx, maxx = df["start1"].min(), df["end1"].max()
-    unique = df["name2"].value_counts()
+    starts = df["start1"].to_numpy()
+    ends = df["end1"].to_numpy()
+    # Queries ranked in order of their first hit
+    rank, names = pd.factorize(df["name2"].astype(str))
+    lanes = pack_lanes(starts, ends)
+    nlanes = int(lanes.max()) + 1 if len(lanes) > 0 else 1
     fig, axes = plt.subplots(1, 1, figsize=(20, 20))
     axes.set_xlim([minx, maxx])
-    axes.set_ylim([0, len(df)])
-    norm = colors.Normalize(0, len(unique))
-    rank = {}
-    y = 0
-    h = 1
-    for (index, row) in df.iterrows():
-        if row["qual"] != 1:
-            # continue
-            pass
-        if row["name2"] not in rank:
-            rank[row["name2"]] = len(rank)
-        c = rank[row["name2"]]
-        start = row["start1"]
-        end = row["start1"] + row["alnSize1"]
-        color = cm.viridis(norm(c))
-        if row["qual"] == 1:
-            axes.add_patch(
-                patches.Rectangle((start, y), end - start, h, facecolor=color)
-            )
-        else:
-            axes.add_patch(
-                patches.Rectangle(
-                    (start, y), end - start, h, facecolor=color, hatch="*"
-                )
-            )
-        axes.text(
-            start * 1.0001,
-            y + 0.1,
-            row["name2"],
-            bbox={"facecolor": "white", "alpha": 1, "pad": 1},
-        )
-        y += h
+    axes.set_ylim([0, nlanes])
+    box = axes.get_position()
+    shape = (int(box.height * 20 * DPI), int(box.width * 20 * DPI))
+    if len(df) > DENSITY_HITS:
+        draw_density(axes, starts, ends, lanes, minx, maxx, nlanes, shape)
+    else:
+        norm = colors.Normalize(0, len(names))
+        facecolors = cm.viridis(norm(rank))
+        hatched = (df["qual"] != 1).to_numpy()
+        draw_hits(axes, starts, ends, lanes, facecolors, hatched)
+        draw_labels(axes, starts, ends, lanes, names[rank], minx, maxx, shape)
     scale_s = "{:.0f}".format(0.1 * (maxx - minx))
     scale = roundup(int(scale_s), len(scale_s) - 1)
     axes.add_patch(
@@ -75,14 +167,15 @@ def plot_coverage(filename):
         maxx - 1.9 * scale, 0 + 0.3, "{} bp".format(scale), color="white", size=18
     )
     figurefile = filename.rsplit(".", 1)[0] + ".png"
-    fig.savefig(figurefile, dpi=90, bbox_inches="tight")
+    fig.savefig(figurefile, dpi=DPI, bbox_inches="tight")
+    plt.close(fig)
 
 
 def main():
     for filename in sys.argv[1:]:
         try:
             plot_coverage(filename)
-        except pd.io.common.EmptyDataError:
+        except pd.errors.EmptyDataError:
             pass
 
 
@@ -1,6 +1,13 @@
 #!/usr/bin/env python3
 """
 Module Docstring
+Each operation works on one parsed record table (see 'read_table'), built once per run,
+and writes the original lines to its outputs with 'route_lines'.
+Several operations can be given as a comma-separated list, e.g.
+    procLast.py single_hit_qc,unique_match,otm_match in.last
+which parses the file once and writes the outputs of all of them in one pass.
+Compressed input (gzip, BGZF, zstd) is read transparently, and '--compress' writes the
+outputs compressed as well.
 """
 
 __author__ = "Harald Grove"
@@ -8,8 +15,30 @@ __version__ = "0.1.0"
 __license__ = "MIT"
 
 import argparse
+import contextlib
 import time
 import sys
+import numpy as np
+import lastio
+import parseLast
+
+# Bytes of the input written by every route before moving on, see 'route_many'
+ROUTEWINDOW = 16 * 1024 * 1024
+# Suffix added to the output files, set with '--compress'
+COMPRESS = ""
+# Operations that can be given to main
+OPERATIONS = [
+    "single_hit_qc",
+    "unique_match",
+    "otm_match",
+    "repeat_ctgs",
+    "gather_network",
+    "filter_bed",
+    "filter_gap_bed",
+    "rbh",
+]
+# Former names of operations
+ALIASES = {"read_graph": "rbh"}
 
 
 def read_last(infile):
@@ -25,447 +54,535 @@ def read_last(infile):
                 db[name2] = {"name1": name1}
 
 
-def single_hit_qc(lastfile):
+def read_table(lastfile, cache=False):
+    """
+    Parses all alignments in lastfile once, see 'parseLast.Last.read_table'.
+    'name1' and 'name2' are integer IDs into 'table.names'.
+    """
+    return parseLast.Last(lastfile).read_table(cache=cache)
+
+
+def outname(lastfile, kind):
+    """ Name of an output file, e.g. 'in.last.gz' and 'qc' gives 'in.qc.txt' """
+    base = lastfile
+    if base.endswith((".gz", ".zst")):
+        base = base.rsplit(".", 1)[0]
+    return "{}.{}.txt{}".format(base.rsplit(".", 1)[0], kind, COMPRESS)
+
+
+def _write_comments(text, fouts):
+    for line in text.splitlines(keepends=True):
+        if line.startswith(b"#"):
+            for fout in fouts:
+                fout.write(line)
+
+
+def route_lines(lastfile, table, targets, outfiles, comments=()):
+    """
+    Copies the original lines of lastfile to the output files in a single pass.
+    Lines are located by the byte offsets in the table, and are not split again.
+    :param table: Records from 'read_table'
+    :param targets: Index into 'outfiles' for each record, -1 to leave it out
+    :param outfiles: Names of the output files
+    :param comments: Indexes into 'outfiles' of the files that also get comment lines
+    """
+    route_many(lastfile, table, [(targets, outfiles, comments)])
+
+
+def route_many(lastfile, table, routes):
+    """
+    Copies the original lines of lastfile to the outputs of several operations,
+    reading the file once. Each route is a (targets, outfiles, comments) tuple,
+    as taken by 'route_lines'.
+    """
+    offset = table.columns["offset"]
+    end = offset + table.columns["length"]
+    runs = []
+    for targets, outfiles, comments in routes:
+        targets = np.asarray(targets)
+        # Adjacent lines going to the same output are written with one call
+        new = np.ones(len(targets), dtype=bool)
+        new[1:] = (targets[1:] != targets[:-1]) | (offset[1:] != end[:-1])
+        first = np.flatnonzero(new)
+        last = np.append(first[1:], len(targets))[: len(first)] - 1
+        runs.append((targets[first], offset[first], end[last]))
+    with contextlib.ExitStack() as stack:
+        fouts = []
+        cfouts = []
+        for targets, outfiles, comments in routes:
+            files = [
+                stack.enter_context(lastio.open_file(name, "wb")) for name in outfiles
+            ]
+            fouts.append(files)
+            cfouts.append([files[ind] for ind in comments])
+        fin = stack.enter_context(lastio.open_file(lastfile, "rb"))
+        # 'data' holds the input from byte 'base' on, up to the furthest line written
+        data = b""
+        base = 0
+        pos = [0] * len(routes)
+        done = [0] * len(routes)
+        # Every route writes its lines from one window of the file before moving on
+        while True:
+            block = fin.read(ROUTEWINDOW)
+            data = data[min(pos) - base :] + block
+            base = min(pos)
+            top = base + len(data)
+            for r, (targets, starts, stops) in enumerate(runs):
+                a = done[r]
+                b = np.searchsorted(stops, top, side="right")
+                window = [col[a:b].tolist() for col in (targets, starts, stops)]
+                for target, start, stop in zip(*window):
+                    if start > pos[r]:
+                        _write_comments(data[pos[r] - base : start - base], cfouts[r])
+                    if target >= 0:
+                        fouts[r][target].write(
+                            data[max(start, pos[r]) - base : stop - base]
+                        )
+                    pos[r] = stop
+                done[r] = b
+                # A run crossing the end of the window is written up to there, so
+                # 'data' does not grow with the length of a run
+                if b < len(stops) and starts[b] < top:
+                    start = int(starts[b])
+                    if start > pos[r]:
+                        _write_comments(data[pos[r] - base : start - base], cfouts[r])
+                    if targets[b] >= 0:
+                        fouts[r][targets[b]].write(data[max(start, pos[r]) - base :])
+                    pos[r] = top
+            if len(block) == 0:
+                break
+        for r in range(len(routes)):
+            if pos[r] < top:
+                _write_comments(data[pos[r] - base :], cfouts[r])
+
+
+def _route(lastfile, table, route, targets, outfiles, comments=()):
+    if route:
+        route_lines(lastfile, table, targets, outfiles, comments)
+        return None
+    return targets, outfiles, comments
+
+
+def single_hit_qc(lastfile, table=None, route=True):
     """ Removes single lines from alignment based on:
         expected score vs. actual score
         adjusted for alignment size
+        Without 'route', the arguments for 'route_many' are returned instead of
+        writing the outputs. The other operations take 'route' in the same way.
     """
-    db = {}
-    with open(lastfile, "r") as fin:
-        for line in fin:
-            if line.startswith("#"):
-                continue
-            score, name1, start1, alnSize1, strand1, seqSize1, name2, start2, alnSize2, strand2, seqSize2, blocks, *e = (
-                line.strip().split()
-            )
-            if int(alnSize2) == int(seqSize2):
-                db[name2] = score
-            if int(alnSize1) == int(seqSize1):
-                db[name1] = score
-    outfile1 = "{}.qc.txt".format(lastfile.rsplit(".", 1)[0])
-    outfile2 = "{}.noise.txt".format(lastfile.rsplit(".", 1)[0])
-    with open(lastfile, "r") as fin, open(outfile1, "w") as fout1, open(
-        outfile2, "w"
-    ) as fout2:
-        for line in fin:
-            if line.startswith("#"):
-                continue
-            score, name1, start1, alnSize1, strand1, seqSize1, name2, start2, alnSize2, strand2, seqSize2, blocks, *e = (
-                line.strip().split()
-            )
-            if int(alnSize2) < 1000:
-                ratio = 6
-            else:
-                ratio = 5
-            if int(score) < int(alnSize2) * ratio:
-                fout2.write(line)
-            else:
-                if int(alnSize2) < int(seqSize2) and name2 in db:
-                    fout2.write(line)
-                elif int(alnSize1) < int(seqSize1) and name1 in db:
-                    fout2.write(line)
-                else:
-                    fout1.write(line)
-
-
-def read_graph(lastfile):
-    """ Records Last entries in a dict:
-        Key: sequence name (both name1 and name2)
-        Value: Score and name of the highest scoring match
+    if table is None:
+        table = read_table(lastfile)
+    cols = table.columns
+    # Sequences completely covered by at least one alignment
+    full = np.zeros(len(table.names), dtype=bool)
+    full[cols["name2"][cols["alnSize2"] == cols["seqSize2"]]] = True
+    full[cols["name1"][cols["alnSize1"] == cols["seqSize1"]]] = True
+    ratio = np.where(cols["alnSize2"] < 1000, 6, 5)
+    noise = (
+        (cols["score"] < cols["alnSize2"] * ratio)
+        | ((cols["alnSize2"] < cols["seqSize2"]) & full[cols["name2"]])
+        | ((cols["alnSize1"] < cols["seqSize1"]) & full[cols["name1"]])
+    )
+    outfile1 = outname(lastfile, "qc")
+    outfile2 = outname(lastfile, "noise")
+    return _route(lastfile, table, route, noise.astype(np.int8), [outfile1, outfile2])
+
+
+def _grow(values, size, fill):
+    if len(values) >= size:
+        return values
+    return np.concatenate([values, np.full(size - len(values), fill, values.dtype)])
+
+
+def best_hits(parts, names):
     """
-    db = {}
-    with open(lastfile, "r") as fin:
-        for line in fin:
-            if line.startswith("#"):
-                continue
-            score, name1, start1, alnSize1, strand1, seqSize1, name2, start2, alnSize2, strand2, seqSize2, blocks, *e = (
-                line.strip().split()
-            )
-            if name2 not in db:
-                db[name2] = {"score": int(score), "name1": name1, "links": []}
-            else:
-                if int(score) > db[name2]["score"]:
-                    db[name2] = {"score": int(score), "name1": name1, "links": []}
-            if name1 not in db:
-                db[name1] = {"score": int(score), "name2": name2, "links": []}
-            else:
-                if int(score) > db[name1]["score"]:
-                    db[name1] = {"score": int(score), "name2": name2, "links": []}
-        for name, entry in db.items():
-            if "name1" in entry:
-                name1 = entry["name1"]
-                db[name1]["links"].append(name)
-            elif "name2" in entry:
-                name2 = entry["name2"]
-                db[name2]["links"].append(name)
-    return db
-
-
-def write_graph(db, outfile):
-    """ Uses dict from 'read_graph' to output the best match from name1 to name2,
-        and name2s best match from name1
+    Finds the best scoring partner of every sequence, as name1 and as name2.
+    Each chunk is reduced to its best line per sequence and merged into the totals,
+    so only arrays over the sequences are kept. Ties go to the first line in the file.
+    :param parts: Iterable of Records sharing 'names'
+    :return: Dict of arrays indexed by name ID: 'score1'/'hit1' for the best name2 of
+        each name1, 'score2'/'hit2' for the best name1 of each name2, and 'first1' with
+        the line where each name1 is first seen (-1 if never)
     """
-    with open(outfile, "w") as fout:
-        for name, entry in db.items():
-            if "name1" in entry:
-                continue
-            name1, score, name2 = name, entry["score"], entry["name2"]
-            try:
-                score2, oname1 = db[name2]["score"], db[name2]["name1"]
-            except KeyError:
-                print(name, name2)
-                print(db[name2])
-            fout.write(
-                "{}\t{}\t{}\t{}\t{}\n".format(name1, score, name2, score2, oname1)
-            )
+    low = np.iinfo(np.int64).min
+    best = {
+        "score1": np.zeros(0, dtype=np.int64),
+        "hit1": np.zeros(0, dtype=np.int64),
+        "score2": np.zeros(0, dtype=np.int64),
+        "hit2": np.zeros(0, dtype=np.int64),
+        "first1": np.zeros(0, dtype=np.int64),
+    }
+    base = 0
+    for part in parts:
+        for key, fill in (("score", low), ("hit", -1), ("first", -1)):
+            for col in [k for k in best if k.startswith(key)]:
+                best[col] = _grow(best[col], len(names), fill)
+        name1, name2 = part.columns["name1"], part.columns["name2"]
+        score = part.columns["score"]
+        for side, key, other in (("1", name1, name2), ("2", name2, name1)):
+            # Best line per sequence, the first one among equal scores
+            order = np.lexsort((-score, key))
+            top = order[np.append(True, np.diff(key[order]) != 0)]
+            ids = key[top]
+            better = score[top] > best["score" + side][ids]
+            best["score" + side][ids[better]] = score[top][better]
+            best["hit" + side][ids[better]] = other[top][better]
+        ids, first = np.unique(name1, return_index=True)
+        new = best["first1"][ids] < 0
+        best["first1"][ids[new]] = base + first[new]
+        base += len(part)
+    return best
+
+
+def reciprocal_best_hits(lastfile, outfile=None, table=None):
+    """
+    Writes the best hit of each name1 and the best hit back from that name2, in the
+    order the name1 sequences are first seen.
+    Without a table the file is read a chunk at a time, using memory for the sequences
+    and not for the lines.
+    :param outfile: Defaults to '<lastfile>.rbh.txt'
+    """
+    if table is None:
+        last = parseLast.Last(lastfile)
+        names = last.names
+        parts = last.iter_table()
+    else:
+        names = table.names
+        parts = [table]
+    best = best_hits(parts, names)
+    if outfile is None:
+        outfile = outname(lastfile, "rbh")
+    name1 = np.flatnonzero(best["first1"] >= 0)
+    name1 = name1[np.argsort(best["first1"][name1])]
+    name2 = best["hit1"][name1]
+    back = best["hit2"][name2]
+    rows = zip(
+        names.decode(name1),
+        best["score1"][name1].tolist(),
+        names.decode(name2),
+        best["score2"][name2].tolist(),
+        names.decode(back),
+        (back == name1).astype(np.int8).tolist(),
+    )
+    with lastio.open_file(outfile, "w") as fout:
+        fout.write("# name1\tscore\tname2\tscore2\tbest1\treciprocal\n")
+        fout.writelines("\t".join(map(str, row)) + "\n" for row in rows)
 
 
-def unique_match(lastfile):
+def unique_match(lastfile, table=None, route=True):
     """ Identifies unique matches, i.e. sequences that only match to each other """
-    db = {}
-    with open(lastfile, "r") as fin:
-        for line in fin:
-            if line.startswith("#"):
-                continue
-            score, name1, start1, alnSize1, strand1, seqSize1, name2, start2, alnSize2, strand2, seqSize2, blocks, *e = (
-                line.strip().split()
-            )
-            if name2 not in db:
-                db[name2] = [name1]
-            elif name1 not in db[name2]:
-                db[name2].append(name1)
-            if name1 not in db:
-                db[name1] = [name2]
-            elif name2 not in db[name1]:
-                db[name1].append(name2)
-    outfile1 = "{}.unique.txt".format(lastfile.rsplit(".", 1)[0])
-    outfile2 = "{}.multi.txt".format(lastfile.rsplit(".", 1)[0])
-    with open(outfile1, "w") as fout1, open(lastfile, "r") as fin, open(
-        outfile2, "w"
-    ) as fout2:
-        for line in fin:
-            if line.startswith("#"):
-                fout1.write(line)
-                fout2.write(line)
-                continue
-            score, name1, start1, alnSize1, strand1, seqSize1, name2, start2, alnSize2, strand2, seqSize2, blocks, *e = (
-                line.strip().split()
-            )
-            if len(db[name1]) == 1 and len(db[name2]) == 1 and db[name1][0] == name2:
-                fout1.write(line)
-            else:
-                fout2.write(line)
+    if table is None:
+        table = read_table(lastfile)
+    degree = parseLast.PartnerIndex.from_table(table).degree
+    name1, name2 = table.columns["name1"], table.columns["name2"]
+    unique = (degree[name1] == 1) & (degree[name2] == 1)
+    targets = np.where(unique, 0, 1).astype(np.int8)
+    outfile1 = outname(lastfile, "unique")
+    outfile2 = outname(lastfile, "multi")
+    return _route(lastfile, table, route, targets, [outfile1, outfile2], [0, 1])
+
+
+def otm_match(lastfile, table=None, route=True):
+    """
+    Identifies one-to-many matches
+    Lines between two sequences with several partners, or where the sequence with
+    several partners has a partner that has several partners itself, are many-to-many.
+    """
+    if table is None:
+        table = read_table(lastfile)
+    index = parseLast.PartnerIndex.from_table(table)
+    name1, name2 = table.columns["name1"], table.columns["name2"]
+    many1, many2 = index.degree[name1] > 1, index.degree[name2] > 1
+    targets = np.full(len(table), -1, dtype=np.int8)
+    targets[many2] = np.where(index.crowded[name2[many2]], 2, 1)
+    targets[many1] = np.where(index.crowded[name1[many1]], 2, 0)
+    targets[many1 & many2] = 2
+    outfile1a = outname(lastfile, "otm1")
+    outfile1b = outname(lastfile, "otm2")
+    outfile2 = outname(lastfile, "mtm")
+    outfiles = [outfile1a, outfile1b, outfile2]
+    return _route(lastfile, table, route, targets, outfiles, [0, 1, 2])
+
+
+def count_overlaps(names, starts, ends):
+    """
+    Counts, for each segment, the other segments on the same sequence that it overlaps,
+    using the test 's_j < e_i and s_i < e_j' of the pairwise comparison.
+    Segments are sorted once and counted with binary searches, O(n log n).
+    Empty or inverted segments (start >= end) are counted exactly like the pairwise
+    test does, which needs an extra two-dimensional count, O(n log^2 n).
+    :param names: Sequence ID of each segment
+    :return: Array with the number of overlapping segments
+    """
+    names = np.asarray(names, dtype=np.int64)
+    starts = np.asarray(starts, dtype=np.int64)
+    ends = np.asarray(ends, dtype=np.int64)
+    if len(names) == 0:
+        return np.zeros(0, dtype=np.int64)
+    # One sorted key space for all sequences: segments on lower-numbered sequences
+    # cancel out of the difference below, so the counts stay per sequence
+    lo = min(starts.min(), ends.min())
+    stride = max(starts.max(), ends.max()) - lo + 1
+    s = names * stride + (starts - lo)
+    e = names * stride + (ends - lo)
+    s_sorted, e_sorted = np.sort(s), np.sort(e)
+    # Overlapping = (s_j < e_i) - (e_j <= s_i) + (s_j >= e_i and e_j <= s_i)
+    count = np.searchsorted(s_sorted, e, side="left")
+    count -= np.searchsorted(e_sorted, s, side="right")
+    if (s >= e).any():
+        count += _count_contained(s, e)
+    # A segment overlaps itself unless it is empty
+    return count - (s < e)
+
+
+def _count_contained(s, e):
+    """ Counts the segments j with s_j >= e_i and e_j <= s_i, for each segment i """
+    order = np.argsort(-s, kind="stable")
+    # Segments with s_j >= e_i come first in this order
+    prefix = np.searchsorted(-s[order], -e, side="right")
+    return parseLast.prefix_count(prefix, e[order], s, strict=False)
+
+
+def repeat_ctgs(lastfile, table=None, route=True):
+    """
+    Removes segments with large amount of hits
+    Both aligned segments of every line are shrunk by 100 bp at each end, and a
+    sequence is a repeat when one of its segments overlaps more than one other segment.
+    """
+    if table is None:
+        table = read_table(lastfile)
+    cols = table.columns
+    names = np.concatenate([cols["name2"], cols["name1"]])
+    starts = np.concatenate([table.column("start2+"), cols["start1"]]) + 100
+    ends = np.concatenate([table.column("end2+"), table.column("end1")]) - 100
+    count = count_overlaps(names, starts, ends)
+    repeat = np.zeros(len(table.names), dtype=bool)
+    repeat[names[count > 1]] = True
+    rep = repeat[cols["name1"]] | repeat[cols["name2"]]
+    outfile1 = outname(lastfile, "normal")
+    outfile2 = outname(lastfile, "repeat")
+    outfiles = [outfile1, outfile2]
+    return _route(lastfile, table, route, rep.astype(np.int8), outfiles, [0, 1])
+
+
+def components(n, u, v):
+    """
+    Labels the connected components of a graph with nodes 0..n-1 and edges (u, v).
+    Array-based union-find: each round hooks the larger root of every edge joining two
+    components under the smaller one, then compresses the paths by pointer jumping,
+    until no edge joins two components.
+    :return: Array with the smallest node of its component for each node
+    """
+    parent = np.arange(n, dtype=np.int64)
+    u, v = np.asarray(u, dtype=np.int64), np.asarray(v, dtype=np.int64)
+    while True:
+        pu, pv = parent[u], parent[v]
+        join = pu != pv
+        if not join.any():
+            return parent
+        u, v, pu, pv = u[join], v[join], pu[join], pv[join]
+        np.minimum.at(parent, np.maximum(pu, pv), np.minimum(pu, pv))
+        while True:
+            grand = parent[parent]
+            if (grand == parent).all():
+                break
+            parent = grand
 
 
-def otm_match(lastfile):
-    """ Identifies one-to-many matches """
-    db = {}
-    with open(lastfile, "r") as fin:
-        for line in fin:
-            if line.startswith("#"):
-                continue
-            score, name1, start1, alnSize1, strand1, seqSize1, name2, start2, alnSize2, strand2, seqSize2, blocks, *e = (
-                line.strip().split()
-            )
-            if name2 not in db:
-                db[name2] = [name1]
-            elif name1 not in db[name2]:
-                db[name2].append(name1)
-            if name1 not in db:
-                db[name1] = [name2]
-            elif name2 not in db[name1]:
-                db[name1].append(name2)
-    outfile1a = "{}.otm1.txt".format(lastfile.rsplit(".", 1)[0])
-    outfile1b = "{}.otm2.txt".format(lastfile.rsplit(".", 1)[0])
-    outfile2 = "{}.mtm.txt".format(lastfile.rsplit(".", 1)[0])
-    with open(lastfile, "r") as fin, open(outfile1a, "w") as fout1a, open(
-        outfile1b, "w"
-    ) as fout1b, open(outfile2, "w") as fout2:
-        for line in fin:
-            if line.startswith("#"):
-                fout1a.write(line)
-                fout1b.write(line)
-                fout2.write(line)
-                continue
-            score, name1, start1, alnSize1, strand1, seqSize1, name2, start2, alnSize2, strand2, seqSize2, blocks, *e = (
-                line.strip().split()
-            )
-            if len(db[name1]) > 1 and len(db[name2]) > 1:
-                fout2.write(line)
-            elif len(db[name1]) > 1:
-                for name in db[name1]:
-                    if len(db[name]) > 1:
-                        fout2.write(line)
-                        break
-                else:
-                    fout1a.write(line)
-            elif len(db[name2]) > 1:
-                for name in db[name2]:
-                    if len(db[name]) > 1:
-                        fout2.write(line)
-                        break
-                else:
-                    fout1b.write(line)
-
-
-def repeat_ctgs(lastfile):
-    """ Removes segments with large amount of hits """
-    db = {}
-    hits = {}
-    with open(lastfile, "r") as fin:
-        for line in fin:
-            if line.startswith("#"):
-                continue
-            score, name1, start1, alnSize1, strand1, seqSize1, name2, start2, alnSize2, strand2, seqSize2, blocks, *e = (
-                line.strip().split()
-            )
-            # Prepare start&end position for both sequences
-            start1 = int(start1)
-            end1 = start1 + int(alnSize1)
-            if strand2 == "+":
-                start2x = int(start2)
-                end2x = start2x + int(alnSize2)
-            else:
-                start2x = int(seqSize2) - (int(start2) + int(alnSize2))
-                end2x = int(seqSize2) - (int(start2))
-            # Add segment to list of already seen segments, update count of overlap
-            if name2 not in db:
-                db[name2] = [[start2x, end2x, 0]]
-            else:
-                count = 0
-                ind = 0
-                while ind < len(db[name2]):
-                    s, e = db[name2][ind][0:2]
-                    if (s + 100) < (end2x - 100) and (start2x + 100) < (e - 100):
-                        count += 1
-                        db[name2][ind][2] += 1
-                    ind += 1
-                db[name2].append([start2x, end2x, count])
-            if name1 not in db:
-                db[name1] = [[start1, end1, 0]]
-            else:
-                count = 0
-                ind = 0
-                while ind < len(db[name1]):
-                    s, e = db[name1][ind][0:2]
-                    if (s + 100) < (end1 - 100) and (start1 + 100) < (e - 100):
-                        count += 1
-                        db[name1][ind][2] += 1
-                    ind += 1
-                db[name1].append([start1, end1, count])
-    outfile1 = "{}.normal.txt".format(lastfile.rsplit(".", 1)[0])
-    outfile2 = "{}.repeat.txt".format(lastfile.rsplit(".", 1)[0])
-    with open(lastfile, "r") as fin, open(outfile1, "w") as fout1, open(
-        outfile2, "w"
-    ) as fout2:
-        for line in fin:
-            if line.startswith("#"):
-                fout1.write(line)
-                fout2.write(line)
-                continue
-            score, name1, start1, alnSize1, strand1, seqSize1, name2, start2, alnSize2, strand2, seqSize2, blocks, *e = (
-                line.strip().split()
-            )
-            rep = False
-            for segment in db[name1]:
-                if segment[2] > 1:
-                    rep = True
-                    break
-            for segment in db[name2]:
-                if segment[2] > 1:
-                    rep = True
-                    break
-            if not rep:
-                fout1.write(line)
-            else:
-                fout2.write(line)
-
-
-def travel(name, db, ctgs, fout):
-    for child in db[name]:
-        try:
-            ctgs.pop(child)
-        except KeyError:
-            continue
-        fout.write("{}\n".format(child))
-        travel(child, db, ctgs, fout)
-
-
-def gather_network(lastfile):
-    """ Identifies all connected sequences """
-    db = {}
-    hits = {}
-    ctg_list = {}
-    with open(lastfile, "r") as fin:
-        for line in fin:
-            if line.startswith("#"):
-                continue
-            score, name1, start1, alnSize1, strand1, seqSize1, name2, start2, alnSize2, strand2, seqSize2, blocks, *e = (
-                line.strip().split()
-            )
-            if name2 not in db:
-                db[name2] = [name1]
-                hits[name2] = [line]
-                ctg_list[name2] = 1
-            elif name1 not in db[name2]:
-                db[name2].append(name1)
-                hits[name2].append(line)
-            if name1 not in db:
-                db[name1] = [name2]
-                ctg_list[name1] = 1
-            elif name2 not in db[name1]:
-                db[name1].append(name2)
-    outfile = "{}.groups.txt".format(lastfile.rsplit(".", 1)[0])
+def gather_network(lastfile, table=None, stats=False):
+    """
+    Identifies all connected sequences
+    Groups are written starting with the most recently seen sequence not yet in a group,
+    followed by the rest of its group in the order first seen.
+    :param stats: Add the number of members, the aligned bases (alnSize1) and the number
+        of distinct sequence pairs (edges) to each group header
+    """
+    if table is None:
+        table = read_table(lastfile)
+    name1, name2 = table.columns["name1"], table.columns["name2"]
+    # Rank of every sequence in the order first seen, name2 before name1 on each line
+    seen = np.stack([name2, name1], axis=1).ravel()
+    nodes, first = np.unique(seen, return_index=True)
+    order = nodes[np.argsort(first)]
+    rank = np.zeros(len(table.names), dtype=np.int64)
+    rank[order] = np.arange(len(order))
+    comp = components(len(table.names), name1, name2)
+    # Every group starts with its last seen member, and groups are in reverse order
+    # of their starting members
+    top = np.zeros(len(table.names), dtype=np.int64)
+    np.maximum.at(top, comp[order], rank[order])
+    top = top[comp[order]]
+    heads = rank[order] == top
+    keep = np.lexsort((rank[order], ~heads, -top))
+    order, heads = order[keep], heads[keep]
+    names = table.names.names
+    if stats:
+        members = np.bincount(comp, minlength=len(names))
+        bases = np.zeros(len(names), dtype=np.int64)
+        np.add.at(bases, comp[name1], table.columns["alnSize1"])
+        pairs = np.unique(
+            np.minimum(name1, name2).astype(np.int64) * len(names)
+            + np.maximum(name1, name2)
+        )
+        edges = np.bincount(comp[pairs // len(names)], minlength=len(names))
+    outfile = outname(lastfile, "groups")
     gr = 0
-    with open(outfile, "w") as fout:
-        while len(ctg_list) > 0:
-            name, value = ctg_list.popitem()
-            fout.write("# group{}\n".format(gr))
-            fout.write("{}\n".format(name))
-            travel(name, db, ctg_list, fout)
-            gr += 1
+    with lastio.open_file(outfile, "w") as fout:
+        for name, head in zip(order.tolist(), heads.tolist()):
+            if head:
+                fout.write("# group{}".format(gr))
+                if stats:
+                    c = comp[name]
+                    fout.write(
+                        "\tmembers={}\taligned={}\tedges={}".format(
+                            members[c], bases[c], edges[c]
+                        )
+                    )
+                fout.write("\n")
+                gr += 1
+            fout.write("{}\n".format(names[name]))
 
 
-def filter_bed(lastfile, bedfile):
+def filter_bed(lastfile, bedfile, table=None, route=True, seq="name1"):
     """
     Selects lines from lastfile that overlaps the regions in bedfile
     :param lastfile:
     :param bedfile:
+    :param seq: 'name1' matches the regions against the first sequence, 'name2' against
+        the second sequence, using its positive-strand coordinates
     :return:
     """
-    db = {}
-    with open(bedfile, "r") as fin:
-        for line in fin:
-            name, start, stop = line.strip().split()
-            if name not in db:
-                db[name] = []
-            db[name].append([int(start), int(stop)])
-    outfile1 = "{}.bed.txt".format(lastfile.rsplit(".", 1)[0])
-    with open(lastfile, "r") as fin, open(outfile1, "w") as fout:
-        for line in fin:
-            if line.startswith("#"):
-                fout.write(line)
-                continue
-            score, name1, start1, alnSize1, strand1, seqSize1, name2, start2, alnSize2, strand2, seqSize2, blocks, *e = (
-                line.strip().split()
-            )
-            if name1 not in db:
-                continue
-            # Prepare start&end position for both sequences
-            start1 = int(start1)
-            end1 = start1 + int(alnSize1)
-            if strand2 == "+":
-                start2x = int(start2)
-                end2x = start2x + int(alnSize2)
-            else:
-                start2x = int(seqSize2) - (int(start2) + int(alnSize2))
-                end2x = int(seqSize2) - (int(start2))
-            for start, stop in db[name1]:
-                if start1 < stop and start < end1:
-                    fout.write(line)
-                    break
-
-
-def filter_gap_bed(lastfile, bedfile):
+    if table is None:
+        table = read_table(lastfile)
+    regions = parseLast.BedIndex.read_bed(bedfile, table.names)
+    if seq == "name1":
+        starts, ends = table.columns["start1"], table.column("end1")
+    else:
+        starts, ends = table.column("start2+"), table.column("end2+")
+    seqs = table.columns[seq]
+    targets = np.full(len(table), -1, dtype=np.int8)
+    for lo in range(0, len(table), parseLast.CHUNKSIZE):
+        hi = lo + parseLast.CHUNKSIZE
+        hit = regions.overlaps(seqs[lo:hi], starts[lo:hi], ends[lo:hi])
+        targets[lo:hi][hit] = 0
+    outfile1 = outname(lastfile, "bed")
+    return _route(lastfile, table, route, targets, [outfile1], [0])
+
+
+def filter_gap_bed(
+    lastfile, bedfile, table=None, route=True, target_bed=None, query_bed=None
+):
     """
         Selects lines from lastfile where a gap overlaps the regions in bedfile
+        For each selected line, the first region in bedfile overlapping one of its gaps
+        is written, widened by 100 bp, to 'target_bed' in the coordinates of the first
+        sequence and to 'query_bed' in those of the second sequence.
         :param lastfile:
-        :param bedfile:
+        :param bedfile: bed-file with four columns, the last one naming the region
+        :param target_bed: Defaults to 'target.bed'
+        :param query_bed: Defaults to 'query.bed'
         :return:
         """
-    db = {}
-    with open(bedfile, "r") as fin:
-        for line in fin:
-            name, start, stop, namex = line.strip().split()
-            if name not in db:
-                db[name] = []
-            db[name].append([int(start), int(stop), namex])
-    outfile1 = "{}.feature.txt".format(lastfile.rsplit(".", 1)[0])
-    outfile2 = "target.bed"
-    outfile3 = "query.bed"
-    with open(lastfile, "r") as fin, open(outfile1, "w") as fout, open(
-        outfile2, "w"
-    ) as fout2, open(outfile3, "w") as fout3:
-        for line in fin:
-            if line.startswith("#"):
-                fout.write(line)
-                continue
-            score, name1, start1, alnSize1, strand1, seqSize1, name2, start2, alnSize2, strand2, seqSize2, blocks, *e = (
-                line.strip().split()
-            )
-            if name1 not in db:
-                continue
-            # Prepare start&end position for both sequences
-            start1 = int(start1)
-            end1 = start1 + int(alnSize1)
-            if strand2 == "+":
-                start2x = int(start2)
-                end2x = start2x + int(alnSize2)
-            else:
-                start2x = int(seqSize2) - (int(start2) + int(alnSize2))
-                end2x = int(seqSize2) - (int(start2))
-            gaps = []
-            x1 = start1
-            for b in blocks.split(","):
-                if ":" in b:
-                    s = x1
-                    b1, b2 = b.split(":")
-                    x1 += int(b1)
-                    e = x1
-                    gaps.append([s, e])
-                else:
-                    x1 += int(b)
-            for start, stop, namex in db[name1]:
-                for s1, e1 in gaps:
-                    if s1 < stop and start < e1:
-                        break
-                else:
-                    continue
-                fout.write(line)
-                fout2.write(
-                    "{}\t{}\t{}\t{}_{}\n".format(
-                        name1,
-                        max(start - 100, 0),
-                        min(stop + 100, int(seqSize1)),
-                        name1,
-                        namex,
-                    )
-                )
-                shift = start - start1
-                fout3.write(
-                    "{}\t{}\t{}\t{}_{}\t0\t{}\n".format(
-                        name2,
-                        max(int(start2) + shift - 100, 0),
-                        min(int(start2) + shift + (stop - start) + 100, int(seqSize2)),
-                        name2,
-                        namex,
-                        strand2,
-                    )
-                )
-                break
+    if table is None:
+        table = read_table(lastfile)
+    regions = parseLast.BedIndex.read_bed(bedfile, table.names, labels=True)
+    cols = table.columns
+    feature = np.full(len(table), len(regions), dtype=np.int64)
+    for lo in range(0, len(table), parseLast.CHUNKSIZE):
+        part = table.slice(lo, min(lo + parseLast.CHUNKSIZE, len(table)))
+        rows, starts, ends = part.gaps()
+        first = regions.first_overlap(part.columns["name1"][rows], starts, ends)
+        found = first >= 0
+        np.minimum.at(feature, lo + rows[found], first[found])
+    selected = np.flatnonzero(feature < len(regions))
+    targets = np.full(len(table), -1, dtype=np.int8)
+    targets[selected] = 0
+    outfile1 = outname(lastfile, "feature")
+    outfile2 = "target.bed" + COMPRESS if target_bed is None else target_bed
+    outfile3 = "query.bed" + COMPRESS if query_bed is None else query_bed
+    # Region coordinates, sorted back into the order of the bed-file
+    index = np.empty(len(regions), dtype=np.int64)
+    index[regions.order] = np.arange(len(regions))
+    feature = index[feature[selected]]
+    start, stop = regions.starts[feature], regions.stops[feature]
+    name1, name2 = cols["name1"][selected], cols["name2"][selected]
+    start2 = cols["start2"][selected] + (start - cols["start1"][selected])
+    target_start = np.maximum(start - 100, 0)
+    target_end = np.minimum(stop + 100, cols["seqSize1"][selected])
+    query_start = np.maximum(start2 - 100, 0)
+    query_end = np.minimum(start2 + (stop - start) + 100, cols["seqSize2"][selected])
+    names = table.names.names
+    labels = regions.labels[regions.order[feature]].tolist()
+    with lastio.open_file(outfile2, "w") as fout2, lastio.open_file(
+        outfile3, "w"
+    ) as fout3:
+        rows = zip(name1.tolist(), target_start.tolist(), target_end.tolist(), labels)
+        fout2.writelines(
+            "{0}\t{1}\t{2}\t{0}_{3}\n".format(names[n1], s, e, label)
+            for n1, s, e, label in rows
+        )
+        rows = zip(
+            name2.tolist(),
+            query_start.tolist(),
+            query_end.tolist(),
+            labels,
+            cols["strand2"][selected].astype("U1").tolist(),
+        )
+        fout3.writelines(
+            "{0}\t{1}\t{2}\t{0}_{3}\t0\t{4}\n".format(names[n2], s, e, label, strand)
+            for n2, s, e, label, strand in rows
+        )
+    return _route(lastfile, table, route, targets, [outfile1], [0])
 
 
 def main(args):
     """ Main entry point of the app """
-    if args.option == "read_graph":
-        db = read_graph(args.infile)
-        write_graph(db, args.outfile)
-    elif args.option == "single_hit_qc":
-        single_hit_qc(args.infile)
-    elif args.option == "unique_match":
-        unique_match(args.infile)
-    elif args.option == "otm_match":
-        otm_match(args.infile)
-    elif args.option == "repeat_ctgs":
-        repeat_ctgs(args.infile)
-    elif args.option == "gather_network":
-        gather_network(args.infile)
-    elif args.option == "filter_bed":
-        filter_bed(args.infile, args.bedfile)
-    elif args.option == "filter_gap_bed":
-        filter_gap_bed(args.infile, args.bedfile)
-    else:
-        sys.stderr.write("Unknown operation: [{}]\n".format(args.option))
+    global COMPRESS
+    if args.compress is not None:
+        COMPRESS = "." + args.compress
+    options = []
+    for option in dict.fromkeys(args.option.split(",")):
+        if option in OPERATIONS or option in ALIASES:
+            option = ALIASES.get(option, option)
+            options.append(option)
+        else:
+            sys.stderr.write("Unknown operation: [{}]\n".format(option))
+    table = None
+    # Reciprocal best hits are found chunk by chunk, unless other operations need the
+    # whole table anyway
+    if any(option != "rbh" or args.cache for option in options):
+        table = read_table(args.infile, cache=args.cache)
+    routes = []
+    for option in options:
+        if option == "rbh":
+            reciprocal_best_hits(args.infile, args.outfile, table)
+        elif option == "single_hit_qc":
+            routes.append(single_hit_qc(args.infile, table, route=False))
+        elif option == "unique_match":
+            routes.append(unique_match(args.infile, table, route=False))
+        elif option == "otm_match":
+            routes.append(otm_match(args.infile, table, route=False))
+        elif option == "repeat_ctgs":
+            routes.append(repeat_ctgs(args.infile, table, route=False))
+        elif option == "gather_network":
+            gather_network(args.infile, table, args.stats)
+        elif option == "filter_bed":
+            routes.append(
+                filter_bed(args.infile, args.bedfile, table, False, args.bedseq)
+            )
+        elif option == "filter_gap_bed":
+            routes.append(
+                filter_gap_bed(
+                    args.infile,
+                    args.bedfile,
+                    table,
+                    False,
+                    args.target_bed,
+                    args.query_bed,
+                )
+            )
+    if len(routes) > 0:
+        route_many(args.infile, table, routes)
     if args.log:
         with open("README.txt", "a") as fout:
             fout.write("[{}]\t[{}]\n".format(time.asctime(), " ".join(sys.argv)))
@@ -476,7 +593,9 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser()
 
     # Required positional argument
-    parser.add_argument("option", help="Action to take")
+    parser.add_argument(
+        "option", help="Action to take, or a comma-separated list of actions"
+    )
     parser.add_argument("infile", help="Input file")
 
     # Optional argument flag which defaults to False
@@ -491,7 +610,40 @@ if __name__ == "__main__":
     # Optional argument which requires a parameter (eg. -d test)
     parser.add_argument("-o", "--outfile", help="Output file")
     parser.add_argument("-b", "--bedfile", help="bed-file")
+    parser.add_argument(
+        "--bedseq",
+        choices=["name1", "name2"],
+        default="name1",
+        help="Sequence matched against the regions of 'filter_bed'",
+    )
+    parser.add_argument(
+        "--stats",
+        action="store_true",
+        default=False,
+        help="Add member, aligned base and edge counts to 'gather_network' groups",
+    )
+    parser.add_argument(
+        "--target-bed",
+        help="Regions written by 'filter_gap_bed' on the first sequence [target.bed]",
+    )
+    parser.add_argument(
+        "--query-bed",
+        help="Regions written by 'filter_gap_bed' on the second sequence [query.bed]",
+    )
     parser.add_argument("-n", "--name", action="store", dest="name")
+    parser.add_argument(
+        "-C",
+        "--cache",
+        action="store_true",
+        default=False,
+        help="Keep the parsed file in a '<infile>.cache' directory and reuse it",
+    )
+    parser.add_argument(
+        "-z",
+        "--compress",
+        choices=["gz", "zst"],
+        help="Compress the output files",
+    )
 
     # Optional verbosity counter (eg. -v, -vv, -vvv, etc.)
     parser.add_argument(
@@ -1,19 +1,354 @@
 #!/usr/bin/env python
 
+"""
+Select the alignments of a LAST tab file that overlap regions of the targets
+Regions are 0-based with the end excluded, as in BED files, and are given as
+'name:start-end', as 'name' for a whole target, or as a BED file ('-b'). The old form
+'chrom start stop' is used for exactly three arguments ending in two numbers, unless a
+BED file is given.
+Without '-i' the alignments are read from stdin and every line is checked.
+'--index' sorts a file by name1 and start1, optionally BGZF-compressed, and writes a
+region index to the sidecar cache of the sorted file ('<file>.cache/region-index/').
+As the linear index of tabix, it holds the offset of the first alignment reaching into
+each bin of BINSIZE positions, so with '-i' a region only reads the alignments from the
+bin of its start up to its end.
+"""
+
+import argparse
+import bisect
+import heapq
+import os
 import sys
+import tempfile
+import numpy as np
+import lastio
+
+# Positions of a target covered by one offset of the index
+BINSIZE = 1 << 14
+# Bytes of alignments sorted in memory at a time by '--index'
+SORTSIZE = 1 << 28
+KIND = "region-index"
+
 
-chrom = sys.argv[1]
-start, stop = int(sys.argv[2]), int(sys.argv[3])
-for line in sys.stdin:
-    if line.startswith("#"):
-        continue
-    line_l = line.strip().split()
+def parse_line(line):
+    """
+    Reads the target and span of an alignment
+    :param line: Line of a LAST tab file, as bytes
+    :return: (name1, start1, end1), or None if the line is not an alignment
+    """
+    l = line.split()
     try:
-        ch, st, en = line_l[1], int(line_l[2]), int(line_l[2]) + int(line_l[3])
-    except ValueError:
-        sys.stdout.write(line)
-        continue
-    if ch != chrom:
-        continue
-    if start < en and stop > st:
-        sys.stdout.write(line)
+        start = int(l[2])
+        return l[1].decode(), start, start + int(l[3])
+    except (IndexError, ValueError):
+        return None
+
+
+def parse_regions(args, legacy=True):
+    """
+    Reads regions from the command line
+    :param legacy: Read exactly three arguments such as 'chr1 100 200' as one region
+    :return: List of (name, start, end)
+    """
+    if legacy and len(args) == 3 and args[1].isdigit() and args[2].isdigit():
+        return [(args[0], int(args[1]), int(args[2]))]
+    regions = []
+    for region in args:
+        name, _, span = region.partition(":")
+        if span == "":
+            regions.append((name, 0, sys.maxsize))
+        else:
+            start, end = span.replace(",", "").split("-")
+            regions.append((name, int(start), int(end)))
+    return regions
+
+
+def read_bed(filename):
+    """ Reads the regions of a BED file as (name, start, end) """
+    regions = []
+    for line in lastio.open_file(filename):
+        l = line.split()
+        if len(l) < 3 or l[0].startswith("#") or l[0] in ("track", "browser"):
+            continue
+        regions.append((l[0], int(l[1]), int(l[2])))
+    return regions
+
+
+class RegionSet(object):
+    """ Regions grouped by target, for testing alignments read in any order """
+
+    def __init__(self, regions):
+        self.starts = {}
+        # Furthest end of the regions up to each one, in order of start
+        self.reach = {}
+        for name, start, end in sorted(regions):
+            self.starts.setdefault(name, []).append(start)
+            reach = self.reach.setdefault(name, [])
+            reach.append(end if len(reach) == 0 else max(end, reach[-1]))
+
+    def overlaps(self, name, start, end):
+        """ Tells if a region of target 'name' has 'rstart < end' and 'rend > start' """
+        starts = self.starts.get(name)
+        if starts is None:
+            return False
+        k = bisect.bisect_left(starts, end)
+        return k > 0 and self.reach[name][k - 1] > start
+
+
+def select_stream(fin, fout, regions):
+    """
+    Writes the alignments overlapping a region, and lines that are not alignments
+    :param fin: Binary file object
+    :param regions: RegionSet
+    """
+    for line in fin:
+        if line.startswith(b"#"):
+            continue
+        hit = parse_line(line)
+        if hit is None or regions.overlaps(*hit):
+            fout.write(line)
+
+
+def sorted_name(filename, bgzf=False):
+    """ Default name of the sorted copy of a file, e.g. 'x.sorted.txt.gz' """
+    for suffix in (".gz", ".bgz", ".zst"):
+        if filename.endswith(suffix):
+            filename = filename[: -len(suffix)]
+    base, dot, ext = filename.rpartition(".")
+    if dot == "" or "/" in ext:
+        base, ext = filename, "txt"
+    return "{}.sorted.{}{}".format(base, ext, ".gz" if bgzf else "")
+
+
+def _sort_key(record):
+    return record[:2]
+
+
+def _spill(records, tmpdir, runs):
+    """ Sorts a batch of alignments and writes it to a new run file in 'tmpdir' """
+    records.sort(key=_sort_key)
+    path = os.path.join(tmpdir, "run{}".format(len(runs)))
+    with open(path, "wb") as fout:
+        fout.writelines(rec[2] for rec in records)
+    runs.append(path)
+
+
+def _read_run(path):
+    with open(path, "rb") as fin:
+        for line in fin:
+            name, start, _ = parse_line(line)
+            yield name, start, line
+
+
+def sort_file(infile, outfile, bgzf=False, batchsize=SORTSIZE):
+    """
+    Writes the alignments of a LAST tab file sorted by name1 and start1, after the
+    comments and other lines that are not alignments
+    Batches of up to 'batchsize' bytes of alignments are sorted in memory and spilled
+    to temporary files next to 'outfile', which are then merged. Alignments with the
+    same name1 and start1 keep their order in the file.
+    """
+    header, records, runs = [], [], []
+    size = 0
+    tmproot = os.path.dirname(os.path.abspath(outfile))
+    with tempfile.TemporaryDirectory(prefix=".sort", dir=tmproot) as tmpdir:
+        with lastio.open_file(infile, "rb") as fin:
+            for line in fin:
+                if not line.endswith(b"\n"):
+                    line += b"\n"
+                hit = None if line.startswith(b"#") else parse_line(line)
+                if hit is None:
+                    header.append(line)
+                    continue
+                records.append((hit[0], hit[1], line))
+                size += len(line)
+                if size >= batchsize:
+                    _spill(records, tmpdir, runs)
+                    records, size = [], 0
+        records.sort(key=_sort_key)
+        # The batch still in memory comes last in the file, so it is merged last
+        merged = heapq.merge(
+            *[_read_run(path) for path in runs], records, key=_sort_key
+        )
+        if bgzf:
+            fout = lastio.BgzfWriter(open(outfile, "wb"))
+        else:
+            fout = lastio.open_file(outfile, "wb")
+        with fout:
+            fout.writelines(header)
+            fout.writelines(rec[2] for rec in merged)
+
+
+class RegionIndex(object):
+    """
+    Index of a plain or BGZF LAST tab file sorted by name1 and start1.
+    'linear' holds the offsets of the bins of every target, those of target i starting
+    at 'first[i]'; see 'build'.
+    """
+
+    def __init__(self, filename, names, first, linear, header, binsize=BINSIZE):
+        self.filename = filename
+        self.names = list(names)
+        self.codes = {name: ind for ind, name in enumerate(self.names)}
+        self.first = first
+        self.linear = linear
+        self.header = header
+        self.binsize = binsize
+
+    @classmethod
+    def open(cls, filename):
+        """ Maps in the cached index of a file, building it if missing or stale """
+        cached = lastio.load_cache(filename, KIND)
+        if cached is None:
+            return cls.build(filename)
+        meta, columns = cached
+        header = [line.encode() for line in meta["header"]]
+        return cls(
+            filename,
+            meta["names"],
+            columns["first"],
+            columns["linear"],
+            header,
+            meta["binsize"],
+        )
+
+    @classmethod
+    def build(cls, filename, binsize=BINSIZE):
+        """
+        Reads a sorted file and writes its index to the sidecar cache
+        The offset of a bin is that of the first alignment of the target ending after
+        the start of the bin. Alignments before it cannot overlap a region starting in
+        the bin or later.
+        """
+        names, header, seen = [], [], set()
+        codes, starts, ends, offsets = [], [], [], []
+        for offset, line in lastio.iter_lines(filename):
+            if line.startswith(b"#"):
+                continue
+            hit = parse_line(line)
+            if hit is None:
+                header.append(line.decode())
+                continue
+            name, start, end = hit
+            new = len(names) == 0 or name != names[-1]
+            if (new and name in seen) or (not new and start < starts[-1]):
+                raise ValueError(
+                    "{} is not sorted by name1 and start1, sort it with "
+                    "'selectTarget.py --index'".format(filename)
+                )
+            if new:
+                seen.add(name)
+                names.append(name)
+            codes.append(len(names) - 1)
+            starts.append(start)
+            ends.append(end)
+            offsets.append(offset)
+        codes = np.array(codes, dtype=np.int64)
+        ends = np.array(ends, dtype=np.int64)
+        offsets = np.array(offsets, dtype=np.int64)
+        bounds = np.searchsorted(codes, np.arange(len(names) + 1))
+        first, parts = [0], []
+        for lo, hi in zip(bounds[:-1].tolist(), bounds[1:].tolist()):
+            reach = np.maximum.accumulate(ends[lo:hi])
+            nbins = max(-(-int(reach[-1]) // binsize), 0)
+            bins = np.arange(nbins, dtype=np.int64) * binsize
+            parts.append(offsets[lo:hi][np.searchsorted(reach, bins, side="right")])
+            first.append(first[-1] + nbins)
+        first = np.array(first, dtype=np.int64)
+        linear = np.concatenate(parts) if len(parts) > 0 else np.zeros(0, np.int64)
+        lastio.save_cache(
+            filename,
+            KIND,
+            {"first": first, "linear": linear},
+            {"names": names, "header": header, "binsize": binsize},
+        )
+        header = [line.encode() for line in header]
+        return cls(filename, names, first, linear, header, binsize)
+
+    def select(self, regions, fout):
+        """
+        Writes the alignments overlapping any of the regions, each once and in the
+        order of the file, after the lines that are not alignments
+        """
+        fout.writelines(self.header)
+        todo = sorted(
+            (self.codes[name], start, end)
+            for name, start, end in regions
+            if name in self.codes and start < end
+        )
+        with lastio.OffsetReader(self.filename) as reader:
+            last, done = -1, 0
+            for code, start, end in todo:
+                # Alignments starting before 'done' were read for an earlier region
+                if code != last:
+                    last, done = code, 0
+                if end <= done:
+                    continue
+                ind = max(start, 0) // self.binsize
+                if ind >= self.first[code + 1] - self.first[code]:
+                    continue
+                offset = int(self.linear[self.first[code] + ind])
+                for line in reader.lines(offset):
+                    hit = parse_line(line)
+                    if hit is None:
+                        continue
+                    name, st, en = hit
+                    if name != self.names[code] or st >= end:
+                        break
+                    if st >= done and en > start:
+                        fout.write(line)
+                done = max(done, end)
+
+
+def main(args):
+    if args.index is not None:
+        outfile = args.outfile or sorted_name(args.index, args.bgzf)
+        sort_file(args.index, outfile, args.bgzf or outfile.endswith(".gz"))
+        RegionIndex.build(outfile)
+        return
+    regions = parse_regions(args.regions, legacy=args.bed is None)
+    if args.bed is not None:
+        regions += read_bed(args.bed)
+    fout = sys.stdout.buffer
+    if args.infile is None:
+        # Compressed input is detected and decompressed on the fly
+        select_stream(
+            lastio.open_file(sys.stdin.buffer, "rb"), fout, RegionSet(regions)
+        )
+    elif lastio.file_compression(args.infile) in (None, "bgzf"):
+        RegionIndex.open(args.infile).select(regions, fout)
+    else:
+        with lastio.open_file(args.infile, "rb") as fin:
+            select_stream(fin, fout, RegionSet(regions))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "regions",
+        nargs="*",
+        help="Regions as 'name:start-end' or 'name'. Without '-b', exactly three "
+        "arguments ending in two numbers are read as one region 'chrom start stop'",
+    )
+    parser.add_argument("-b", "--bed", help="BED file of regions")
+    parser.add_argument(
+        "-i",
+        "--infile",
+        help="Sorted LAST tab file, read through its index [stdin, read in full]",
+    )
+    parser.add_argument(
+        "--index",
+        metavar="FILE",
+        help="Sort FILE and index the sorted copy, instead of selecting",
+    )
+    parser.add_argument(
+        "-o", "--outfile", help="Sorted copy written by '--index' [FILE.sorted.txt]"
+    )
+    parser.add_argument(
+        "-z",
+        "--bgzf",
+        action="store_true",
+        default=False,
+        help="BGZF-compress the sorted copy, also done for names ending in '.gz'",
+    )
+    main(parser.parse_args())
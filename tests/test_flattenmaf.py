@@ -0,0 +1,42 @@
+import io
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import flattenmaf
+
+GAPLESS = """##maf version=1
+a score=1
+s chr1 2 5 + 20 ACGTA
+s s1_x 0 5 + 9 ACGTT
+
+a score=2
+s chr1 10 3 + 20 GGG
+s s2_y 4 3 + 9 GGC
+
+"""
+
+
+def flatten(maf, region=None):
+    proj, size = flattenmaf.convertmaf2(str(maf), region)
+    fout = io.BytesIO()
+    flattenmaf.printmaf(proj, size, fout)
+    return fout.getvalue().decode()
+
+
+def test_gapless(tmp_path):
+    maf = tmp_path / "gapless.maf"
+    maf.write_text(GAPLESS)
+    assert flatten(maf) == (
+        ">chr1\n---ACGTA---GGG------\n"
+        ">s1\n---ACGTT------------\n"
+        ">s2\n-----------GGC------\n"
+    )
+
+
+def test_region_without_blocks(tmp_path):
+    maf = tmp_path / "gapless.maf"
+    maf.write_text(GAPLESS)
+    for region in ("chr1:0-1", "chr1:7-9", "chrZ:0-5"):
+        assert flatten(maf, region) == ""